@@ -0,0 +1,137 @@
+"""
+Adaptive Concurrency
+--------------------
+AIMD (additive increase, multiplicative decrease) limit on concurrent downloads,
+driven by measured throughput and by the rate of throttling errors.
+
+Every ``interval`` seconds the limiter compares aggregate download throughput with
+the previous window:
+
+    - a share of throttled downloads (HTTP 403/429) at or above ``error_threshold``
+      cuts the limit by ``decrease_factor``
+    - a window in which every slot was busy adds one slot to probe for more bandwidth
+    - if the probe did not add at least ``marginal_gain`` of an average slot's
+      throughput, the link is saturated and the slot is removed again
+
+After a decrease or a failed probe the limit holds for ``cooldown_windows`` windows
+before probing again, so it settles instead of oscillating.
+
+On a fast link the limit keeps climbing towards ``max_limit``; on a slow or
+throttled one it stays low.
+
+Classes:
+    - AimdLimiter
+
+Functions:
+    - is_throttling_error
+"""
+
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+THROTTLING_PATTERN = re.compile(r"HTTP Error (403|429)|Too Many Requests|rate.?limit", re.IGNORECASE)
+
+
+def is_throttling_error(message: str) -> bool:
+    """Whether a download error message looks like YouTube refusing or rate limiting requests."""
+    return bool(THROTTLING_PATTERN.search(message or ""))
+
+
+class AimdLimiter:
+    def __init__(self, bytes_source: Callable[[], int], min_limit: int = 1, max_limit: int = 16,
+                 initial_limit: int = 2, interval: float = 3.0, marginal_gain: float = 0.5,
+                 decrease_factor: float = 0.5, error_threshold: float = 0.2, cooldown_windows: int = 5) -> None:
+        """
+        Args:
+            bytes_source (Callable): Returns the total bytes downloaded so far, e.g. metrics.download_bytes
+            min_limit (int): Fewest concurrent downloads
+            max_limit (int): Most concurrent downloads
+            initial_limit (int): Starting limit
+            interval (float): Seconds between adjustments
+            marginal_gain (float): Share of an average slot's throughput a new slot must add to be kept
+            decrease_factor (float): Multiplier applied to the limit when throttled
+            error_threshold (float): Share of throttled downloads in a window that triggers a decrease
+            cooldown_windows (int): Windows to hold the limit after backing off
+        """
+        self.bytes_source = bytes_source
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.interval = interval
+        self.marginal_gain = marginal_gain
+        self.decrease_factor = decrease_factor
+        self.error_threshold = error_threshold
+        self.cooldown_windows = cooldown_windows
+
+        self.active = 0
+        self._condition = threading.Condition()
+        self._window_start = time.monotonic()
+        self._window_bytes = bytes_source()
+        self._window_busy = False
+        self._window_done = 0
+        self._window_throttled = 0
+        self._last_throughput: Optional[float] = None
+        self._just_increased = False
+        self._hold = 0
+
+    def acquire(self) -> None:
+        """Block until a download slot is free under the current limit."""
+        with self._condition:
+            self._adjust()
+            while self.active >= self.limit:
+                self._condition.wait(timeout=self.interval)
+                self._adjust()
+            self.active += 1
+            if self.active >= self.limit:
+                self._window_busy = True
+
+    def release(self, throttled: bool = False) -> None:
+        """Free a slot and record whether the finished download was throttled."""
+        with self._condition:
+            self.active -= 1
+            self._window_done += 1
+            self._window_throttled += throttled
+            self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self) -> None:
+        """Close the current window if it is old enough and move the limit. Caller holds the lock."""
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+
+        total_bytes = self.bytes_source()
+        throughput = (total_bytes - self._window_bytes) / elapsed
+        throttled_share = self._window_throttled / self._window_done if self._window_done else 0.0
+        previous = self._last_throughput
+        old_limit = self.limit
+
+        probe_failed = (self._just_increased and previous is not None
+                        and throughput < previous * (1 + self.marginal_gain / max(self.limit - 1, 1)))
+        self._just_increased = False
+        if self._window_throttled and throttled_share >= self.error_threshold:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+            self._hold = self.cooldown_windows
+        elif probe_failed:
+            # The last added slot did not buy its share of throughput, give it back
+            self.limit = max(self.min_limit, self.limit - 1)
+            self._hold = self.cooldown_windows
+        elif self._hold:
+            self._hold -= 1
+        elif self._window_busy and self.limit < self.max_limit:
+            self.limit += 1
+            self._just_increased = True
+
+        if self.limit != old_limit:
+            print(f"⚙️  Download concurrency {old_limit} -> {self.limit} "
+                  f"({throughput / 1e6:.2f} MB/s, {self._window_throttled}/{self._window_done} throttled)")
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_bytes = total_bytes
+        self._window_busy = self.active >= self.limit
+        self._window_done = 0
+        self._window_throttled = 0
@@ -0,0 +1,409 @@
+"""
+Offline Benchmark
+-----------------
+Runs the playlist pipeline end to end against local stand-ins, so performance can
+be measured without API quota or network access and compared between commits.
+
+One local HTTP server plays every remote service:
+    - /youtube/v3/search and /youtube/v3/videos: a fake YouTube Data API
+    - /v1/chat/completions: a fake OpenAI-compatible chat endpoint that always picks
+      candidate 0, with configurable latency
+    - /media/<videoId>.mp3: generated silent MP3 files of the video's duration,
+      downloaded by yt-dlp's generic extractor
+    - /cover/<albumId>.jpg: placeholder album art
+
+A synthetic playlist of configurable size is pushed through run_playlist_pipeline
+exactly like main.main does. A share of the tracks (--llm-share) gets ambiguous
+search results that the local scorer cannot resolve, so they go to the LLM.
+
+Caches, the media store and downloads live in a temporary directory, so every run
+starts cold.
+The transcode stage needs ffmpeg and ffprobe on PATH, as in a real run.
+
+The report covers tracks/min, p50/p99 latency per stage and peak RSS. It can be
+saved with --json and compared against a saved baseline with --baseline, in which
+case the exit code is 1 when throughput or memory regress beyond --tolerance.
+
+Usage:
+    python bench.py --tracks 200 --llm-share 0.3 --llm-latency 0.8 --json bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from spotify_api import Album, Artist, SpotifyTrack
+
+# One MPEG-1 Layer III frame header: 128 kbps, 44.1 kHz, stereo. A frame of zeros after it
+# decodes as silence, so files of any duration can be generated without an encoder.
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x00"
+MP3_FRAME_BYTES = 417
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + bytes(512) + b"\xff\xd9"
+
+CANDIDATES_PER_SEARCH = 5
+TRACK_NAME_PATTERN = re.compile(r"Bench Song (\d+)")
+
+
+def synthetic_duration_ms(index: int) -> int:
+    """Deterministic track length between 2:30 and 4:30."""
+    return (150 + (index * 37) % 120) * 1000
+
+
+def synthetic_playlist(size: int, album_size: int = 12, image_base_url: str | None = None) -> list[SpotifyTrack]:
+    """Build ``size`` tracks spread over albums of ``album_size`` tracks by a handful of artists."""
+    tracks = []
+    for index in range(size):
+        album_index = index // album_size
+        artist = Artist(id=f"artist{album_index % 25}", name=f"Bench Artist {album_index % 25}")
+        album = Album(
+            id=f"album{album_index}",
+            name=f"Bench Album {album_index}",
+            artists=[artist],
+            imageUrl=f"{image_base_url}/cover/album{album_index}.jpg" if image_base_url else None,
+        )
+        tracks.append(SpotifyTrack(
+            id=f"track{index:07d}",
+            name=f"Bench Song {index:06d}",
+            artists=[artist],
+            album=album,
+            durationMs=synthetic_duration_ms(index),
+        ))
+    return tracks
+
+
+def synthetic_mp3(duration_ms: int) -> bytes:
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_BYTES - len(MP3_FRAME_HEADER))
+    return frame * int(duration_ms / 1000 * MP3_FRAMES_PER_SECOND)
+
+
+def _iso_duration(duration_ms: int) -> str:
+    minutes, seconds = divmod(duration_ms // 1000, 60)
+    return f"PT{minutes}M{seconds}S"
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the stand-in settings for its handlers."""
+    daemon_threads = True
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.random_lock = threading.Lock()
+        self.requests = {"search": 0, "videos": 0, "chat": 0, "media": 0, "cover": 0}
+        self._media: dict[int, bytes] = {}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def delay(self, latency: float) -> None:
+        """Sleep for ``latency`` seconds, give or take the configured jitter."""
+        if latency <= 0:
+            return
+        with self.random_lock:
+            factor = self.random.uniform(1 - self.args.jitter, 1 + self.args.jitter)
+        time.sleep(latency * factor)
+
+    def is_ambiguous(self, index: int) -> bool:
+        """Whether a track's search results are left for the LLM to decide."""
+        return random.Random(f"{self.args.seed}:{index}").random() < self.args.llm_share
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections mid-read are expected, not worth a traceback
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def media(self, duration_ms: int) -> bytes:
+        data = self._media.get(duration_ms)
+        if data is None:
+            data = self._media[duration_ms] = synthetic_mp3(duration_ms)
+        return data
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandInServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str = "application/json", status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload: dict, status: int = 200) -> None:
+        self._send(json.dumps(payload).encode("utf-8"), status=status)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith("/youtube/v3/search"):
+            self._search(query.get("q", [""])[0], int(query.get("maxResults", [CANDIDATES_PER_SEARCH])[0]))
+        elif url.path.endswith("/youtube/v3/videos"):
+            self._videos(query.get("id", [""])[0].split(","))
+        elif url.path.startswith("/media/"):
+            self._media(url.path.rsplit("/", 1)[-1].split(".")[0])
+        elif url.path.startswith("/cover/"):
+            self.server.requests["cover"] += 1
+            self._send(FAKE_JPEG, "image/jpeg")
+        else:
+            self._send_json({"error": f"unknown path {url.path}"}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if urlparse(self.path).path.endswith("/chat/completions"):
+            self._chat(body)
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, 404)
+
+    def _search(self, q: str, max_results: int) -> None:
+        self.server.requests["search"] += 1
+        self.server.delay(self.server.args.search_latency)
+        match = TRACK_NAME_PATTERN.search(q)
+        index = int(match.group(1)) if match else 0
+        song = f"Bench Song {index:06d}"
+        artist = q[match.end():].strip() if match else "Unknown"
+        items = []
+        for k in range(min(max_results, CANDIDATES_PER_SEARCH)):
+            if self.server.is_ambiguous(index):
+                # Bare titles on unrelated channels score below the local match threshold
+                title, channel = (song, f"Uploader {k}") if k == 0 else (f"{song} (Live)", f"Uploader {k}")
+            elif k == 0:
+                title, channel = f"{artist} - {song} (Official Audio)", f"{artist} - Topic"
+            else:
+                title, channel = f"{song} cover", f"Cover Channel {k}"
+            items.append({
+                "id": {"videoId": f"b{index:07d}v{k}x"},
+                "snippet": {
+                    "title": title,
+                    "channelTitle": channel,
+                    "publishedAt": "2024-01-01T00:00:00Z",
+                    "description": f"Synthetic upload of {song}.",
+                },
+            })
+        self._send_json({"items": items})
+
+    def _videos(self, video_ids: list[str]) -> None:
+        self.server.requests["videos"] += 1
+        self.server.delay(self.server.args.search_latency)
+        items = [
+            {"id": video_id, "contentDetails": {"duration": _iso_duration(synthetic_duration_ms(int(video_id[1:8])))}}
+            for video_id in video_ids if len(video_id) == 11
+        ]
+        self._send_json({"items": items})
+
+    def _media(self, video_id: str) -> None:
+        self.server.requests["media"] += 1
+        self.server.delay(self.server.args.media_latency)
+        try:
+            data = self.server.media(synthetic_duration_ms(int(video_id[1:8])))
+        except ValueError:
+            return self._send_json({"error": f"unknown video {video_id}"}, 404)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        bandwidth = self.server.args.media_bandwidth
+        chunk_size = 64 * 1024
+        try:
+            for offset in range(0, len(data), chunk_size):
+                self.wfile.write(data[offset:offset + chunk_size])
+                if bandwidth > 0:
+                    time.sleep(chunk_size / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            # yt-dlp's generic extractor only reads the headers of its first request
+            pass
+
+    def _chat(self, body: dict) -> None:
+        self.server.requests["chat"] += 1
+        self.server.delay(self.server.args.llm_latency)
+        schema = (body.get("response_format") or {}).get("json_schema", {}).get("name", "")
+        prompt = body["messages"][-1]["content"]
+        if schema == "BatchVideoSelection":
+            tracks = re.findall(r"^Track (\d+):", prompt, re.MULTILINE)
+            parsed = {"selections": [{"track": int(n), "index": 0, "reason": "Bench pick"} for n in tracks]}
+        else:
+            parsed = {"index": 0, "reason": "Bench pick"}
+        self._send_json({
+            "id": f"bench-{self.server.requests['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "bench"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": json.dumps(parsed)},
+            }],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 16, "total_tokens": len(prompt) // 4 + 16},
+        })
+
+
+def peak_rss_mb() -> tuple[float, float]:
+    """Peak resident set size of this process and of its largest child (the ffmpeg workers), in MB."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return own / scale, children / scale
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """Start the stand-ins, run the pipeline over a synthetic playlist and collect the report."""
+    workdir = tempfile.mkdtemp(prefix="freemium-bench-")
+    server = StandInServer(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Module-level settings are read on import, so point them at the stand-ins first
+    os.environ.update({
+        "YOUTUBE_API_KEY": "bench",
+        "YOUTUBE_API_ENDPOINT": f"{server.base_url}/",
+        "YOUTUBE_SEARCH_CACHE_PATH": os.path.join(workdir, "youtube.sqlite3"),
+        "OPENROUTER_API_KEY": "bench",
+        "OPENROUTER_BASE_URL": f"{server.base_url}/v1",
+        "LLM_SELECTION_CACHE_PATH": os.path.join(workdir, "llm.sqlite3"),
+        "LLM_REQUESTS_PER_MINUTE": str(args.llm_rpm),
+        "COVER_ART_CACHE_DIR": os.path.join(workdir, "cover_art"),
+        "MEDIA_STORE_DIR": os.path.join(workdir, "media"),
+    })
+    import metrics
+    from manifest import DownloadManifest
+    from pipeline import PipelineConfig, run_playlist_pipeline
+
+    tracks = synthetic_playlist(args.tracks, image_base_url=server.base_url)
+    output_path = os.path.join(workdir, "downloads")
+    config = PipelineConfig(
+        output_path=output_path,
+        search_workers=args.search_workers,
+        search_backend=args.search_backend,
+        select_workers=args.select_workers,
+        select_batch_size=args.select_batch_size,
+        download_workers=args.download_workers,
+        transcode_workers=args.transcode_workers,
+        audio_format=args.audio_format,
+        video_url_template=f"{server.base_url}/media/{{video_id}}.mp3",
+    )
+
+    print(f"🧪 Benchmark: {len(tracks)} synthetic tracks, {args.llm_share:.0%} left to the LLM")
+    print(f"🌐 Stand-ins at {server.base_url}, working directory {workdir}")
+    start = time.perf_counter()
+    try:
+        jobs = asyncio.run(run_playlist_pipeline(tracks, config, DownloadManifest.for_output_path(output_path)))
+        elapsed = time.perf_counter() - start
+        data = metrics.summary()
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    own_rss, child_rss = peak_rss_mb()
+    successful = sum(1 for job in jobs if job.success)
+    return {
+        "tracks": len(tracks),
+        "successful": successful,
+        "elapsed_s": elapsed,
+        "tracks_per_minute": successful / elapsed * 60,
+        "download_mb_per_s": data["bytes_per_second"] / 1e6,
+        "peak_rss_mb": own_rss,
+        "peak_child_rss_mb": child_rss,
+        "requests": dict(server.requests),
+        "stages": {
+            stage: {"count": row["count"], "errors": row["errors"], "p50_s": row["p50"], "p99_s": row["p99"]}
+            for stage, row in sorted(data["stages"].items())
+        },
+        "settings": {key: value for key, value in vars(args).items() if key not in ("json", "baseline", "keep")},
+    }
+
+
+def print_report(report: dict) -> None:
+    print("\n" + "=" * 60)
+    print("🧪 BENCHMARK REPORT")
+    print("=" * 60)
+    print(f"✅ {report['successful']}/{report['tracks']} tracks in {report['elapsed_s']:.1f}s "
+          f"({report['tracks_per_minute']:.1f} tracks/min)")
+    print(f"⬇️  {report['download_mb_per_s']:.2f} MB/s downloaded")
+    print(f"🧠 Peak RSS: {report['peak_rss_mb']:.0f} MB (largest worker process {report['peak_child_rss_mb']:.0f} MB)")
+    print(f"🌐 Stand-in requests: {', '.join(f'{name} {count}' for name, count in report['requests'].items())}")
+    print(f"{'stage':<22}{'calls':>8}{'errors':>8}{'p50 s':>10}{'p99 s':>10}")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<22}{row['count']:>8}{row['errors']:>8}{row['p50_s']:>10.3f}{row['p99_s']:>10.3f}")
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return a description of every regression beyond ``tolerance`` (a fraction, e.g. 0.1)."""
+    regressions = []
+    if report["tracks_per_minute"] < baseline["tracks_per_minute"] * (1 - tolerance):
+        regressions.append(f"throughput {report['tracks_per_minute']:.1f} tracks/min, "
+                           f"baseline {baseline['tracks_per_minute']:.1f}")
+    if report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS {report['peak_rss_mb']:.0f} MB, baseline {baseline['peak_rss_mb']:.0f} MB")
+    if report["successful"] < baseline["successful"]:
+        regressions.append(f"{report['successful']} tracks succeeded, baseline {baseline['successful']}")
+    return regressions
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the playlist pipeline.")
+    parser.add_argument("--tracks", type=int, default=100, help="Synthetic playlist size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for ambiguous tracks and latency jitter")
+    parser.add_argument("--llm-share", type=float, default=0.3, help="Share of tracks the local scorer cannot resolve")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per fake chat completion")
+    parser.add_argument("--llm-rpm", type=float, default=6000, help="LLM requests per minute allowed by the client")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="Seconds per fake YouTube API call")
+    parser.add_argument("--media-latency", type=float, default=0.05, help="Seconds before a media response starts")
+    parser.add_argument("--media-bandwidth", type=float, default=0, help="Bytes/s per media response, 0 for unlimited")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Relative latency jitter, 0.2 means +-20%%")
+    parser.add_argument("--search-workers", type=int, default=4)
+    parser.add_argument("--search-backend", choices=["data_api", "auto"], default="data_api",
+                        help="'auto' falls back to real yt-dlp searches, which need network access")
+    parser.add_argument("--select-workers", type=int, default=4)
+    parser.add_argument("--select-batch-size", type=int, default=1)
+    parser.add_argument("--download-workers", type=int, default=3)
+    parser.add_argument("--transcode-workers", type=int, default=None)
+    parser.add_argument("--audio-format", choices=["mp3", "native"], default="mp3")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Compare against a report saved with --json")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative regression against the baseline")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    report = run_benchmark(args)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"📝 Report written to {args.json}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regression: {regression}")
+        if regressions:
+            return 1
+        print("✅ No regression against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
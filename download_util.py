@@ -9,18 +9,34 @@ Functions:
     - get_content_type
     - parse_multiple_urls
     - get_available_formats
+    - get_format_options
+    - format_profile
+    - transcode_file
+    - new_transcode_pool
     - download_single_video
     - download_youtube_content
 """
 
 from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor import get_postprocessor
+import json
+import multiprocessing
 import os
 import re
+import threading
+import time
+from contextlib import nullcontext
 from typing import Optional, List, Dict, Tuple
 from urllib.parse import urlparse, parse_qs
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from functools import lru_cache
 
+import metrics
+from adaptive_concurrency import AimdLimiter, is_throttling_error
+
+# Ceiling for adaptive download concurrency in download_youtube_content
+MAX_DOWNLOAD_WORKERS = int(os.getenv("MAX_DOWNLOAD_WORKERS", 16))
+
 
 @lru_cache(maxsize=128)
 def get_url_info(url: str) -> Tuple[str, Dict]:
@@ -175,7 +191,141 @@ def get_available_formats(url: str) -> None:
         print(f"Error listing formats: {str(e)}")
 
 
-def download_single_video(url: str, output_path: str, file_name: str, thread_id: int = 0, audio_only: bool = False) -> dict:
+def get_format_options(audio_only: bool = False, audio_format: str = 'mp3') -> Tuple[str, Optional[str], List[Dict]]:
+    """
+    yt-dlp format selector, final file extension and ffmpeg postprocessors for a download mode.
+
+    Args:
+        audio_only (bool): If True, download audio only
+        audio_format (str): 'mp3' or 'native', see download_single_video
+
+    Returns:
+        Tuple[str, Optional[str], List[Dict]]: (format_selector, file_extension, postprocessors).
+        file_extension is None when it depends on the source stream.
+    """
+    if audio_only and audio_format == 'native':
+        # Keep the original audio stream; 'best' makes FFmpegExtractAudio copy the codec
+        # into its natural container (.opus or .m4a) instead of re-encoding
+        return 'bestaudio/best', None, [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'best',
+        }]
+    if audio_only:
+        # Configure for audio-only MP3 downloads
+        return 'bestaudio/best', 'mp3', [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }]
+    # Configure for video downloads
+    format_selector = (
+        # Try best video+audio combination first
+        'bestvideo[height<=1080]+bestaudio/best[height<=1080]/'
+        # Fallback to best available quality
+        'best'
+    )
+    return format_selector, 'mp4', [{
+        'key': 'FFmpegVideoConvertor',
+        'preferedformat': 'mp4',
+    }]
+
+
+def transcode_file(raw_path: str, audio_only: bool = False, audio_format: str = 'mp3') -> dict:
+    """
+    Run the ffmpeg post-processing step on a raw download made with postprocess=False.
+    Designed to run in a process pool, separate from the network-bound download workers.
+
+    Args:
+        raw_path (str): File downloaded by yt-dlp, in its source container
+        audio_only (bool): If True, extract audio only
+        audio_format (str): 'mp3' or 'native', see download_single_video
+
+    Returns:
+        dict: Result with 'success', 'filepath' (the final file), 'seconds' and 'message'.
+        The caller records 'seconds' in metrics, since this usually runs in another process
+    """
+    _, _, postprocessors = get_format_options(audio_only, audio_format)
+    start = time.perf_counter()
+    info = {'filepath': raw_path, 'ext': os.path.splitext(raw_path)[1].lstrip('.').lower()}
+    try:
+        with YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+            for pp_def in postprocessors:
+                pp_def = dict(pp_def)
+                pp = get_postprocessor(pp_def.pop('key'))(ydl, **pp_def)
+                files_to_delete, info = pp.run(info)
+                for path in files_to_delete:
+                    if path != info['filepath'] and os.path.exists(path):
+                        os.remove(path)
+    except Exception as e:
+        return {'filepath': raw_path, 'success': False, 'seconds': time.perf_counter() - start,
+                'message': f"❌ Transcode failed for {raw_path}: {e}"}
+    return {'filepath': info['filepath'], 'success': True, 'seconds': time.perf_counter() - start,
+            'message': f"🎛️  Transcoded: {info['filepath']}"}
+
+
+def format_profile(audio_only: bool = False, audio_format: str = 'mp3') -> str:
+    """
+    Short name of the file a download mode produces, e.g. 'audio-mp3-192' or 'audio-native'.
+    Used to key stored downloads in the media store, so it changes whenever get_format_options does.
+    """
+    _, file_extension, postprocessors = get_format_options(audio_only, audio_format)
+    quality = postprocessors[0].get('preferredquality')
+    return '-'.join(part for part in ('audio' if audio_only else 'video', file_extension or 'native', quality) if part)
+
+
+def new_transcode_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Process pool for transcode_file, one worker per CPU core by default.
+    Workers are spawned, not forked: the callers have download, HTTP and SQLite threads
+    running, and a forked child can inherit a lock one of them holds and hang.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+# Long-lived YoutubeDL instances, one per worker thread and option set
+_worker_state = threading.local()
+
+
+def _count_progress_bytes(progress: Dict) -> None:
+    """yt-dlp progress hook feeding the download byte counter with the bytes received since its last call."""
+    seen = getattr(_worker_state, 'progress_bytes', None)
+    if seen is None:
+        seen = _worker_state.progress_bytes = {}
+    filename = progress.get('filename')
+    downloaded = progress.get('downloaded_bytes') or 0
+    metrics.add_bytes(max(downloaded - seen.get(filename, 0), 0))
+    if progress.get('status') == 'downloading':
+        seen[filename] = downloaded
+    else:
+        seen.pop(filename, None)
+
+
+def get_worker_downloader(ydl_opts: Dict) -> YoutubeDL:
+    """
+    Return this thread's YoutubeDL for the given options, creating it on first use.
+
+    The instance is kept for the thread's lifetime so its cookies and open connections
+    carry over between downloads. Only the output template changes per call; it is
+    updated in place. Post hooks are routed to the list in _worker_state.final_paths.
+    """
+    downloaders = getattr(_worker_state, 'downloaders', None)
+    if downloaders is None:
+        downloaders = _worker_state.downloaders = {}
+
+    opts = {k: v for k, v in ydl_opts.items() if k not in ('outtmpl', 'post_hooks')}
+    key = json.dumps(opts, sort_keys=True, default=str)
+    ydl = downloaders.get(key)
+    if ydl is None:
+        opts['post_hooks'] = [lambda path: _worker_state.final_paths.append(path)]
+        ydl = downloaders[key] = YoutubeDL(opts)
+    ydl.params['outtmpl']['default'] = ydl_opts['outtmpl']
+    return ydl
+
+
+def download_single_video(url: str, output_path: str, file_name: str, thread_id: int = 0, audio_only: bool = False,
+                          audio_format: str = 'mp3', postprocess: bool = True,
+                          content_type: Optional[str] = None, reuse_downloader: bool = False) -> dict:
     """
     Download a single YouTube video, playlist, or channel.
 
@@ -183,37 +333,29 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
         url (str): YouTube URL to download (video, playlist, or channel)
         output_path (str): Directory to save the download
         thread_id (int): Thread identifier for logging
-        audio_only (bool): If True, download audio only in MP3 format
+        audio_only (bool): If True, download audio only
+        audio_format (str): 'mp3' to transcode audio to 192 kbps MP3, or 'native' to keep the
+            best audio stream as-is (Opus or AAC/M4A), remuxed without re-encoding
+        postprocess (bool): If False, skip the ffmpeg step and leave the raw download on disk
+            for transcode_file to process later
+        content_type (str, optional): 'video', 'playlist' or 'channel' if already known.
+            When omitted the URL is probed with get_url_info first
+        reuse_downloader (bool): Use this thread's long-lived YoutubeDL instance, keeping its
+            cookies and open connections, instead of building a new one for this download
 
     Returns:
-        dict: Result status with success/failure info
+        dict: Result status with success/failure info. Successful downloads include
+        'files', every file written, and single-video downloads also 'filepath'.
     """
     # Ensure output directory exists
     os.makedirs(output_path, exist_ok=True)
 
+    format_selector, _, postprocessors = get_format_options(audio_only, audio_format)
     if audio_only:
-        # Configure for audio-only MP3 downloads
-        format_selector = 'bestaudio/best'
-        file_extension = 'mp3'
-        postprocessors = [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }]
-        print(f"🎵 [Thread {thread_id}] Audio-only mode: Downloading MP3...")
-    else:
-        # Configure for video downloads
-        format_selector = (
-            # Try best video+audio combination first
-            'bestvideo[height<=1080]+bestaudio/best[height<=1080]/'
-            # Fallback to best available quality
-            'best'
-        )
-        file_extension = 'mp4'
-        postprocessors = [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',
-        }]
+        print(f"🎵 [Thread {thread_id}] Audio-only mode: Downloading {'native audio stream' if audio_format == 'native' else 'MP3'}...")
+    if not postprocess:
+        # The caller runs the ffmpeg step separately with transcode_file
+        postprocessors = []
 
     # Configure yt-dlp options
     ydl_opts = {
@@ -226,6 +368,7 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
         'writethumbnail': False,
         'writeautomaticsub': False,
         'postprocessors': postprocessors,
+        'progress_hooks': [_count_progress_bytes],
         # Clean up options
         'keepvideo': False,
         'clean_infojson': True,
@@ -239,8 +382,17 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
     if not audio_only:
         ydl_opts['merge_output_format'] = 'mp4'
 
-    # Set different output templates for playlists, channels and single videos
-    content_type, cached_info = get_url_info(url)
+    # Remember where post-processing leaves the final file, its extension is only known afterwards
+    final_paths: List[str] = []
+    if reuse_downloader:
+        _worker_state.final_paths = final_paths
+    else:
+        ydl_opts['post_hooks'] = [final_paths.append]
+
+    # Set different output templates for playlists, channels and single videos.
+    # Only probe the URL when the caller did not say what it is; the probe is a network call.
+    if content_type is None:
+        content_type, _ = get_url_info(url)
 
     # Debug: Print detection result
     if thread_id == 1:  # Only print for first thread to avoid spam
@@ -260,17 +412,27 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
         ydl_opts['outtmpl'] = os.path.join(
             output_path, file_name)
         print(f"🎥 [Thread {thread_id}] Detected single video URL. Downloading {'audio' if audio_only else 'video'}...")
+    # Playlists and channels skip unavailable entries; a single video should fail with yt-dlp's
+    # error, so callers can tell throttling (HTTP 403/429) apart from other failures
+    ydl_opts['ignoreerrors'] = content_type != 'video'
+    # Files keep their source extension; ffmpeg post-processing swaps it for the target's,
+    # and a native-container audio stream that is not converted keeps it for good
+    ydl_opts['outtmpl'] += '.%(ext)s'
 
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            # Extract fresh info for download (cached info is only for detection)
+        # A reused downloader stays open for the worker's next download
+        downloader = nullcontext(get_worker_downloader(ydl_opts)) if reuse_downloader else YoutubeDL(ydl_opts)
+        with downloader as ydl, metrics.timer('ytdlp.download'):
+            # Extract once; the same info dict is reused for the download below
             info = ydl.extract_info(url, download=False)
 
             # Check if info extraction was successful
             if info is None:
+                metrics.record_error('ytdlp.download')
                 return {
                     'url': url,
                     'success': False,
+                    'content_type': content_type,
                     'message': f"❌ [Thread {thread_id}] Failed to extract video information. Video may be private or unavailable."
                 }
 
@@ -281,14 +443,16 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
 
                 # Ensure we have entries to download
                 if video_count == 0:
+                    metrics.record_error('ytdlp.download')
                     return {
                         'url': url,
                         'success': False,
+                        'content_type': content_type,
                         'message': f"❌ [Thread {thread_id}] {content_type.title()} appears to be empty or private"
                     }
 
-            # Download content
-            ydl.download([url])
+            # Download content from the already extracted info instead of extracting it again
+            result = ydl.process_ie_result(info, download=True)
 
             if info.get('_type') == 'playlist':
                 title = info.get('title', f'Unknown {content_type.title()}')
@@ -296,12 +460,20 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
                 return {
                     'url': url,
                     'success': True,
+                    'content_type': content_type,
+                    'files': final_paths,
                     'message': f"✅ [Thread {thread_id}] {content_type.title()} '{title}' download completed! ({video_count} {'MP3s' if audio_only else 'videos'})"
                 }
             else:
+                # Post hooks report the final file; without them fall back to what yt-dlp wrote
+                requested = (result or {}).get('requested_downloads') or [{}]
+                filepath = final_paths[-1] if final_paths else requested[-1].get('filepath')
                 return {
                     'url': url,
                     'success': True,
+                    'content_type': content_type,
+                    'filepath': filepath,
+                    'files': final_paths or ([filepath] if filepath else []),
                     'message': f"✅ [Thread {thread_id}] {'Audio' if audio_only else 'Video'} download completed successfully!"
                 }
 
@@ -309,22 +481,35 @@ def download_single_video(url: str, output_path: str, file_name: str, thread_id:
         return {
             'url': url,
             'success': False,
+            'content_type': content_type,
             'message': f"❌ [Thread {thread_id}] Error: {str(e)}"
         }
 
 
 def download_youtube_content(urls: List[str], output_path: Optional[str] = None,
-                             list_formats: bool = False, max_workers: int = 3, audio_only: bool = False) -> None:
+                             list_formats: bool = False, max_workers: Optional[int] = None, audio_only: bool = False,
+                             audio_format: str = 'mp3', transcode_workers: Optional[int] = None) -> None:
     """
     Download YouTube content (single videos, playlists, or channels) in MP4 format or MP3 audio only.
     Supports multiple URLs for simultaneous downloading.
 
+    Downloading and ffmpeg post-processing run as two stages: a thread pool sized for
+    bandwidth fetches raw files, and each finished file is queued on a process pool sized
+    to the CPU cores for transcoding, so neither resource waits on the other.
+
+    Unless max_workers is given, download concurrency adapts to the link: an AIMD limiter
+    adds workers while measured throughput keeps rising and backs off when it flattens or
+    downloads start failing with HTTP 403/429.
+
     Args:
         urls (List[str]): List of YouTube URLs to download (videos, playlists, or channels)
         output_path (str, optional): Directory to save the downloads. Defaults to './downloads'
         list_formats (bool): If True, only list available formats without downloading
-        max_workers (int): Maximum number of concurrent downloads
-        audio_only (bool): If True, download audio only in MP3 format
+        max_workers (int, optional): Fixed number of concurrent downloads. Defaults to adaptive
+            concurrency between 1 and MAX_DOWNLOAD_WORKERS
+        audio_only (bool): If True, download audio only
+        audio_format (str): 'mp3' or 'native', see download_single_video
+        transcode_workers (int, optional): ffmpeg worker processes. Defaults to the number of CPU cores
     """
     # Set default output path if none provided
     if output_path is None:
@@ -339,46 +524,58 @@ def download_youtube_content(urls: List[str], output_path: Optional[str] = None,
     # Create output directory if it doesn't exist
     os.makedirs(output_path, exist_ok=True)
 
+    # Each call reports on its own downloads only; reset before the limiter reads the byte counter
+    metrics.reset()
+
+    # Without a fixed worker count, the pool is sized for the ceiling and the limiter decides how many run
+    limiter = None if max_workers else AimdLimiter(metrics.download_bytes, max_limit=MAX_DOWNLOAD_WORKERS)
+    workers_label = f"{max_workers} concurrent workers" if max_workers else f"adaptive concurrency (1-{MAX_DOWNLOAD_WORKERS} workers)"
     print(
-        f"\n🚀 Starting download of {len(urls)} URL(s) with {max_workers} concurrent workers...")
+        f"\n🚀 Starting download of {len(urls)} URL(s) with {workers_label}...")
     print(f"📁 Output directory: {output_path}")
-    print(f"🎧 Format: {'MP3 Audio Only' if audio_only else 'MP4 Video'}")
-
-    # Show what types of content we're downloading
-    playlist_count = sum(
-        1 for url in urls if get_content_type(url) == 'playlist')
-    channel_count = sum(
-        1 for url in urls if get_content_type(url) == 'channel')
-    video_count = len(urls) - playlist_count - channel_count
-
-    content_summary = []
-    if playlist_count > 0:
-        content_summary.append(f"{playlist_count} playlist(s)")
-    if channel_count > 0:
-        content_summary.append(f"{channel_count} channel(s)")
-    if video_count > 0:
-        content_summary.append(f"{video_count} video(s)")
-
-    if content_summary:
-        print(f"📋 Content: {' + '.join(content_summary)}")
-    else:
-        print("🎥 Content: Unknown content type")
+    audio_label = 'Native Audio Only' if audio_format == 'native' else 'MP3 Audio Only'
+    print(f"🎧 Format: {audio_label if audio_only else 'MP4 Video'}")
 
     print("-" * 60)
 
-    # Concurrent downloads
+    def download(url: str, thread_id: int) -> dict:
+        # Each task classifies its own URL, so probing runs concurrently instead of up front
+        if limiter is None:
+            return download_single_video(url, output_path, '%(title)s', thread_id=thread_id, audio_only=audio_only,
+                                         audio_format=audio_format, postprocess=False, reuse_downloader=True)
+        limiter.acquire()
+        throttled = False
+        try:
+            result = download_single_video(url, output_path, '%(title)s', thread_id=thread_id, audio_only=audio_only,
+                                           audio_format=audio_format, postprocess=False, reuse_downloader=True)
+            throttled = not result['success'] and is_throttling_error(result['message'])
+            return result
+        finally:
+            limiter.release(throttled)
+
+    # Concurrent downloads feeding a separate transcode pool
     results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_url = {
-            executor.submit(download_single_video, url, output_path, i+1, audio_only): url
-            for i, url in enumerate(urls)
-        }
+    transcode_failures = []
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_DOWNLOAD_WORKERS) as executor, \
+            new_transcode_pool(transcode_workers) as transcoder:
+        future_to_url = {executor.submit(download, url, i + 1): url for i, url in enumerate(urls)}
 
-        # Collect results
+        # Queue each raw file for transcoding as soon as its download finishes
+        transcode_futures = []
         for future in as_completed(future_to_url):
             result = future.result()
             results.append(result)
             print(result['message'])
+            for raw_path in result.get('files', []):
+                transcode_futures.append(transcoder.submit(transcode_file, raw_path, audio_only, audio_format))
+
+        for future in as_completed(transcode_futures):
+            transcoded = future.result()
+            metrics.observe('ffmpeg.transcode', transcoded['seconds'])
+            if not transcoded['success']:
+                metrics.record_error('ffmpeg.transcode')
+                transcode_failures.append(transcoded)
+                print(transcoded['message'])
 
     print("\n" + "=" * 60)
     print("📊 DOWNLOAD SUMMARY")
@@ -387,6 +584,25 @@ def download_youtube_content(urls: List[str], output_path: Optional[str] = None,
     successful = [r for r in results if r['success']]
     failed = [r for r in results if not r['success']]
 
+    # Show what types of content we downloaded
+    content_types = [r.get('content_type') for r in results]
+    playlist_count = content_types.count('playlist')
+    channel_count = content_types.count('channel')
+    video_count = content_types.count('video')
+
+    content_summary = []
+    if playlist_count > 0:
+        content_summary.append(f"{playlist_count} playlist(s)")
+    if channel_count > 0:
+        content_summary.append(f"{channel_count} channel(s)")
+    if video_count > 0:
+        content_summary.append(f"{video_count} video(s)")
+
+    if content_summary:
+        print(f"📋 Content: {' + '.join(content_summary)}")
+    else:
+        print("🎥 Content: Unknown content type")
+
     print(f"✅ Successful downloads: {len(successful)}")
     print(f"❌ Failed downloads: {len(failed)}")
 
@@ -396,8 +612,15 @@ def download_youtube_content(urls: List[str], output_path: Optional[str] = None,
             print(f"   • {result['url']}")
             print(f"     Reason: {result['message']}")
 
+    if transcode_failures:
+        print(f"\n❌ Failed transcodes: {len(transcode_failures)}")
+        for transcoded in transcode_failures:
+            print(f"   • {transcoded['filepath']}")
+
     if successful:
         print(f"\n🎉 All files saved to: {output_path}")
 
+    metrics.print_summary()
+
 
     
\ No newline at end of file
@@ -1,44 +1,189 @@
-from mutagen.id3 import ID3
+import mutagen
+from mutagen.flac import Picture
+from mutagen.id3 import ID3, ID3NoHeaderError
 from mutagen.id3._frames import TIT2, TPE1, TPE2, TALB, TLEN, APIC
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.oggopus import OggOpus
+from mutagen.oggvorbis import OggVorbis
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
+import base64
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
 
+import metrics
+from manifest import DownloadManifest
 from spotify_api import SpotifyTrack
 import requests
+from requests.adapters import HTTPAdapter
 
+COVER_ART_CACHE_DIR = os.getenv("COVER_ART_CACHE_DIR", ".cache/cover_art")
+COVER_ART_MEMORY_ITEMS = 64
+MIME_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png"}
 
-class AudioFile:
-    def __init__(self, path) -> None:
-        self.path = Path(path)
-        self.audio = ID3(self.path)
+# Tag keys for the text fields of containers that are not tagged with ID3 frames
+TEXT_KEYS = {
+    "mp4": {"title": "\xa9nam", "artist": "\xa9ART", "albumartist": "aART", "album": "\xa9alb"},
+    "vorbis": {"title": "title", "artist": "artist", "albumartist": "albumartist", "album": "album"},
+}
 
-    def modify_metadata(self, metadata: SpotifyTrack):
-        self.modify_name(metadata.name)
-        self.modify_track_artists([artist.name for artist in metadata.artists])
-        self.modify_album_artists([artist.name for artist in metadata.album.artists])
-        self.modify_album_name(metadata.album.name)
-        self.modify_length(metadata.durationMs)
-        if metadata.album.imageUrl:
-            self.modify_art(metadata.album.imageUrl)
-        self.save()
 
-    def fetch_image(self, imgUrl: str):
-        response = requests.get(imgUrl)
+class CoverArtCache:
+    """
+    Album cover cache shared by every AudioFile.
+
+    Images are keyed by URL and kept in a small in-memory LRU backed by a content
+    store on disk. Downloads go through one pooled requests session, and threads
+    asking for the same image at the same time wait for a single fetch.
+    """
+
+    def __init__(self, cache_dir: str = COVER_ART_CACHE_DIR, memory_items: int = COVER_ART_MEMORY_ITEMS,
+                 pool_size: int = 16) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.memory_items = memory_items
+        self._memory: OrderedDict[str, tuple[bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: dict[str, threading.Lock] = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _disk_path(self, imgUrl: str, mime_type: str) -> Path:
+        digest = hashlib.sha1(imgUrl.encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{digest}{MIME_EXTENSIONS[mime_type]}"
+
+    def _remember(self, imgUrl: str, image: tuple[bytes, str]) -> None:
+        with self._lock:
+            self._memory[imgUrl] = image
+            self._memory.move_to_end(imgUrl)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _from_memory(self, imgUrl: str):
+        with self._lock:
+            image = self._memory.get(imgUrl)
+            if image is not None:
+                self._memory.move_to_end(imgUrl)
+            return image
+
+    def _from_disk(self, imgUrl: str):
+        for mime_type in MIME_EXTENSIONS:
+            path = self._disk_path(imgUrl, mime_type)
+            if path.exists():
+                return path.read_bytes(), mime_type
+        return None
+
+    def _download(self, imgUrl: str):
+        response = self.session.get(imgUrl, timeout=30)
         if response.status_code != 200:
             print(f"Failed to fetch image from URL: {imgUrl}")
-            return None, None
+            return None
 
         mime_type = response.headers.get("Content-Type", "")
-        if mime_type not in ["image/jpeg", "image/png"]:
+        if mime_type not in MIME_EXTENSIONS:
             print(f"Unsupported image type: {mime_type}")
-            return None, None
+            return None
 
+        path = self._disk_path(imgUrl, mime_type)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f"{path.suffix}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(response.content)
+        os.replace(tmp_path, path)
         return response.content, mime_type
 
+    def get(self, imgUrl: str):
+        """Return (image_data, mime_type) for an image URL, or (None, None) if it cannot be fetched."""
+        image = self._from_memory(imgUrl)
+        if image is not None:
+            return image
+
+        # One lock per URL so concurrent requests for the same cover share a single fetch
+        with self._lock:
+            url_lock = self._inflight.setdefault(imgUrl, threading.Lock())
+        with url_lock:
+            image = self._from_memory(imgUrl) or self._from_disk(imgUrl)
+            if image is None:
+                try:
+                    with metrics.timer("cover_art.fetch"):
+                        image = self._download(imgUrl)
+                except requests.RequestException as e:
+                    print(f"Failed to fetch image from URL: {imgUrl} ({e})")
+            if image is not None:
+                self._remember(imgUrl, image)
+        with self._lock:
+            self._inflight.pop(imgUrl, None)
+        return image if image is not None else (None, None)
+
+
+cover_art_cache = CoverArtCache()
+
+
+class AudioFile:
+    """
+    Tags an audio file with Spotify metadata.
+    MP3 files get ID3 frames; M4A/MP4 and Ogg Opus/Vorbis files, as kept by the
+    native-container download mode, get their container's own tags.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        # Detect the container from the file's contents; the extension can be missing or wrong
+        detected = mutagen.File(self.path)
+        if isinstance(detected, MP4):
+            self.kind = "mp4"
+            self.audio = detected
+            if self.audio.tags is None:
+                self.audio.add_tags()
+        elif isinstance(detected, (OggOpus, OggVorbis)):
+            self.kind = "vorbis"
+            self.audio = detected
+        else:
+            self.kind = "id3"
+            try:
+                self.audio = ID3(self.path)
+            except ID3NoHeaderError:
+                self.audio = ID3()
+
+    def modify_metadata(self, metadata: SpotifyTrack):
+        with metrics.timer("id3.tag"):
+            self.modify_name(metadata.name)
+            self.modify_track_artists([artist.name for artist in metadata.artists])
+            self.modify_album_artists([artist.name for artist in metadata.album.artists])
+            self.modify_album_name(metadata.album.name)
+            self.modify_length(metadata.durationMs)
+            if metadata.album.imageUrl:
+                self.modify_art(metadata.album.imageUrl)
+            self.save()
+
+    def fetch_image(self, imgUrl: str):
+        return cover_art_cache.get(imgUrl)
+
+    def _set_text(self, field: str, values: list[str]):
+        self.audio[TEXT_KEYS[self.kind][field]] = values
+
     def modify_art(self, imgUrl: str):
         image_data, mime_type = self.fetch_image(imgUrl)
         if not image_data or not mime_type:
             return
 
+        if self.kind == "mp4":
+            image_format = MP4Cover.FORMAT_PNG if mime_type == "image/png" else MP4Cover.FORMAT_JPEG
+            self.audio["covr"] = [MP4Cover(image_data, imageformat=image_format)]
+            return
+        if self.kind == "vorbis":
+            picture = Picture()
+            picture.type = 3
+            picture.mime = mime_type
+            picture.desc = "Cover Art"
+            picture.data = image_data
+            self.audio["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
+            return
+
         image = APIC(
             encoding=3,
             mime=mime_type,
@@ -50,32 +195,126 @@ class AudioFile:
         self.audio.add(image)
 
     def modify_name(self, new_name: str):
+        if self.kind != "id3":
+            return self._set_text("title", [new_name])
         self.audio.delall("TIT2")
         self.audio.add(TIT2(encoding=3, text=new_name))
     
     def modify_track_artists(self, new_artists: list[str]):
+        if self.kind != "id3":
+            return self._set_text("artist", new_artists)
         self.audio.delall("TPE1")
         self.audio.add(TPE1(encoding=3, text=new_artists))
 
     def modify_album_artists(self, new_artists: list[str]):
+        if self.kind != "id3":
+            return self._set_text("albumartist", new_artists)
         self.audio.delall("TPE2")
         self.audio.add(TPE2(encoding=3, text=new_artists))
     
     def modify_album_name(self, new_name: str):
+        if self.kind != "id3":
+            return self._set_text("album", [new_name])
         self.audio.delall("TALB")
         self.audio.add(TALB(encoding=3, text=new_name))
     
     def modify_length(self, new_length: int):
+        # MP4 and Ogg store the real duration in the stream itself
+        if self.kind != "id3":
+            return
         self.audio.delall("TLEN")
         self.audio.add(TLEN(encoding=3, text=str(new_length)))
 
     def save(self):
-        self.audio.save()
+        if self.kind == "id3":
+            self.audio.save(self.path)
+        else:
+            self.audio.save()
 
     def print_metadata(self):
         self.audio.pprint()
 
 
+def _retag_file(path: str, track_data: dict) -> dict:
+    """Process pool worker: write every frame for one file with a single save()."""
+    start = time.perf_counter()
+    try:
+        AudioFile(path).modify_metadata(SpotifyTrack(**track_data))
+        return {"path": path, "success": True, "seconds": time.perf_counter() - start, "message": ""}
+    except Exception as e:
+        return {"path": path, "success": False, "seconds": time.perf_counter() - start, "message": str(e)}
+
+
+def retag_files(files: list[tuple[str, SpotifyTrack]], max_workers: int | None = None) -> list[dict]:
+    """
+    Re-tag many existing audio files in parallel.
+
+    Cover art is fetched once per album in this process first, so the worker
+    processes read it from the shared on-disk store instead of downloading it again.
+
+    Args:
+        files (list): (path, SpotifyTrack) pairs
+        max_workers (int, optional): Worker processes, defaults to the number of CPU cores
+
+    Returns:
+        list[dict]: One result per file with 'path', 'success', 'seconds' and 'message'
+    """
+    image_urls = {track.album.imageUrl for _, track in files if track.album.imageUrl}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(cover_art_cache.get, image_urls))
+
+    start = time.perf_counter()
+    results = []
+    # Spawned, not forked: forking while the cover art session's threads hold locks can deadlock the children
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(_retag_file, str(path), track.model_dump()) for path, track in files]
+        for future in as_completed(futures):
+            result = future.result()
+            # Worker processes have their own metrics registry, so record their timings here
+            metrics.observe("id3.tag", result["seconds"])
+            if not result["success"]:
+                metrics.record_error("id3.tag")
+            results.append(result)
+
+    elapsed = time.perf_counter() - start
+    failed = [result for result in results if not result["success"]]
+    print(f"🏷️  Re-tagged {len(results) - len(failed)}/{len(results)} files in {elapsed:.1f}s")
+    if results:
+        slowest = max(results, key=lambda result: result["seconds"])
+        print(f"   Slowest file: {slowest['path']} ({slowest['seconds']:.2f}s)")
+    for result in failed:
+        print(f"   ❌ {result['path']}: {result['message']}")
+    return results
+
+
+def retag_from_manifest(manifest: DownloadManifest, tracks: list[SpotifyTrack],
+                        max_workers: int | None = None) -> list[dict]:
+    """
+    Re-tag every downloaded file in a manifest with fresh Spotify metadata and update the manifest.
+
+    Args:
+        manifest (DownloadManifest): Manifest of downloaded files
+        tracks (list[SpotifyTrack]): Current metadata; tracks missing from the manifest are ignored
+        max_workers (int, optional): Worker processes, defaults to the number of CPU cores
+
+    Returns:
+        list[dict]: Per-file results, as returned by retag_files
+    """
+    files = []
+    for track in tracks:
+        entry = manifest.get(track.id)
+        if entry is not None and os.path.exists(entry.path):
+            files.append((entry.path, track))
+
+    results = retag_files(files, max_workers)
+    succeeded = {result["path"] for result in results if result["success"]}
+    for path, track in files:
+        if path in succeeded:
+            manifest.record(track, manifest.get(track.id).videoId, path)
+    manifest.save()
+    return results
+
+
 if __name__ == "__main__":
     mp3_file_path = "downloads/echo-of-my-shadow.mp3"
     audio = AudioFile(mp3_file_path)
@@ -6,10 +6,16 @@ Module for LLM chat completion using OpenAI SDK with OpenRouter as the model pro
 import json
 import os
 import asyncio
-from openai import OpenAI
+import random
+import threading
+import time
+import weakref
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any, Union, Type, TypeVar
+from typing import Optional, List, Dict, Any, Tuple, Union, Type, TypeVar
 from dotenv import load_dotenv
+import metrics
+from sqlite_cache import SqliteCache
 load_dotenv()
 
 # Pydantic models for structured responses
@@ -20,42 +26,186 @@ class YouTubeSearchQuery(BaseModel):
 class VideoSelection(BaseModel):
     """Model for video selection response."""
     index: int = Field(..., description="Index of the selected video from the search results", ge=0)
+    reason: str = Field(..., description="Explanation for why this video was selected")
+
+class TrackVideoSelection(VideoSelection):
+    """Model for one track's selection inside a batched response."""
+    track: int = Field(..., description="Number of the track this selection belongs to", ge=0)
+
+class BatchVideoSelection(BaseModel):
+    """Model for a batched video selection response covering several tracks."""
+    selections: List[TrackVideoSelection] = Field(..., description="One selection per track")
 
 # You should set your OpenRouter API key as an environment variable: OPENROUTER_API_KEY
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
-LLM_MODEL = "openai/gpt-oss-120b"
+# Any OpenAI-compatible endpoint works, e.g. a local stand-in for benchmarks
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_MODEL = os.getenv("LLM_MODEL", "openai/gpt-oss-120b")
+
+# Bump whenever the selection prompt changes so cached selections made with the old prompt are ignored
+SELECTION_PROMPT_VERSION = 3
+SELECTION_CACHE_PATH = os.getenv("LLM_SELECTION_CACHE_PATH", ".cache/llm.sqlite3")
+SELECTION_CACHE_MAX_ENTRIES = int(os.getenv("LLM_SELECTION_CACHE_MAX_ENTRIES", 100_000))
+
+# Request pacing, tunable from .env; LLM_REQUESTS_PER_MINUTE=0 turns the rate limit off
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", 60))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 60))
+LLM_BACKOFF_BASE_SECONDS = 1.0
+LLM_BACKOFF_MAX_SECONDS = 60.0
 
 if not OPENROUTER_API_KEY:
     raise EnvironmentError("OPENROUTER_API_KEY environment variable not set.")
 
-client = OpenAI(
+# Retries are handled by chat_completion so they share the rate limiter
+client = AsyncOpenAI(
     api_key=OPENROUTER_API_KEY,
-    base_url=OPENROUTER_BASE_URL
+    base_url=OPENROUTER_BASE_URL,
+    max_retries=0
 )
 
+
+class TokenBucket:
+    """Async token bucket that spreads requests evenly over a per-minute budget. A rate of 0 means no limit."""
+
+    def __init__(self, rate_per_minute: float, burst: Optional[int] = None) -> None:
+        if rate_per_minute < 0:
+            raise ValueError(f"rate_per_minute must be 0 (no limit) or positive, got {rate_per_minute}")
+        self.rate = rate_per_minute / 60
+        self.capacity = float(burst if burst is not None else max(1, int(self.rate * 10)))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a request token is available and consume it."""
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# asyncio primitives belong to the loop that first waits on them, so every running loop
+# (one per asyncio.run) gets its own concurrency limit and request budget
+_loop_limits: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[asyncio.Semaphore, TokenBucket]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _request_limits() -> Tuple[asyncio.Semaphore, TokenBucket]:
+    """Concurrency semaphore and rate limiter of the running event loop, created on first use."""
+    loop = asyncio.get_running_loop()
+    limits = _loop_limits.get(loop)
+    if limits is None:
+        limits = _loop_limits[loop] = (asyncio.Semaphore(LLM_MAX_CONCURRENCY), TokenBucket(LLM_REQUESTS_PER_MINUTE))
+    return limits
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (APITimeoutError, APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def _backoff_delay(attempt: int, error: Exception) -> float:
+    """Full-jitter exponential backoff, honouring Retry-After when the provider sends one."""
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), LLM_BACKOFF_MAX_SECONDS)
+            except ValueError:
+                pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+_selection_cache: Optional[SqliteCache] = None
+_selection_cache_lock = threading.Lock()
+
+
+def get_selection_cache() -> SqliteCache:
+    """Return the shared on-disk cache of LLM video selections, opening it on first use."""
+    global _selection_cache
+    # Locked so concurrent first selections share one cache instead of each opening their own
+    with _selection_cache_lock:
+        if _selection_cache is None:
+            _selection_cache = SqliteCache(
+                SELECTION_CACHE_PATH,
+                table="video_selection",
+                max_entries=SELECTION_CACHE_MAX_ENTRIES,
+            )
+    return _selection_cache
+
+
+def selection_cache_key(track_id: str, search_results: List[Dict[str, Any]]) -> str:
+    """Key a selection by track, ordered candidate ids, model and prompt version."""
+    video_ids = ",".join(str(result.get('videoId', '')) for result in search_results)
+    return f"{track_id}|{LLM_MODEL}|v{SELECTION_PROMPT_VERSION}|{video_ids}"
+
+
+def invalidate_selection(track_id: Optional[str] = None) -> int:
+    """
+    Drop cached selections so they are resolved by the LLM again.
+    Args:
+        track_id (str, optional): Only drop selections for this track. Drops everything if omitted.
+    Returns:
+        int: Number of cached selections removed
+    """
+    cache = get_selection_cache()
+    if track_id is None:
+        return cache.clear()
+    return cache.delete_prefix(f"{track_id}|")
+
+
 # Type variable for Pydantic models
 T = TypeVar('T', bound=BaseModel)
 
-async def chat_completion(messages: List[Dict[str, str]], response_model: Optional[Type[T]]) -> T:
+async def chat_completion(messages: List[Dict[str, str]], response_model: Optional[Type[T]],
+                          timeout: float = LLM_TIMEOUT_SECONDS) -> T:
     """
     Async: Get a chat completion from the LLM using OpenRouter as the provider.
+    Calls in the same event loop share a concurrency limit and requests-per-minute budget, and are retried
+    with jittered exponential backoff on rate limits (429), server errors (5xx) and timeouts.
     Args:
         messages (list): List of message dicts, e.g. [{"role": "user", "content": "Hello!"}]
         response_model (BaseModel, optional): Pydantic model for structured response
+        timeout (float): Seconds allowed for each attempt
     Returns:
         str or BaseModel: The assistant's reply as string or parsed structured model
     """
-    try:
-        # Use structured output with JSON object
-        response = client.chat.completions.parse(
-            model=LLM_MODEL,
-            messages=messages,  # type: ignore
-            response_format=VideoSelection
-        )
-    except Exception as e:
-        raise ValueError(f"LLM response parsing failed: {e}")
+    attempt = 0
+    while True:
+        try:
+            request_semaphore, rate_limiter = _request_limits()
+            async with request_semaphore:
+                await rate_limiter.acquire()
+                # Use structured output with JSON object
+                with metrics.timer("llm.chat"):
+                    response = await asyncio.wait_for(
+                        client.chat.completions.parse(
+                            model=LLM_MODEL,
+                            messages=messages,  # type: ignore
+                            response_format=response_model or VideoSelection,
+                            timeout=timeout
+                        ),
+                        timeout=timeout
+                    )
+            break
+        except Exception as e:
+            if attempt < LLM_MAX_RETRIES and _is_retryable(e):
+                await asyncio.sleep(_backoff_delay(attempt, e))
+                attempt += 1
+                continue
+            raise ValueError(f"LLM response parsing failed: {e}")
     # Parse and validate the response with Pydantic
     content = response.choices[0].message.parsed
     if content is None:
@@ -88,43 +238,153 @@ async def generate_youtube_search_query(song_metadata):
         return result.query
     return ""
 
-async def select_best_youtube_video(song_metadata, search_results):
+SELECTION_SYSTEM_PROMPT = "You are an expert at matching songs to YouTube videos."
+
+
+def _format_duration(duration_ms: Optional[int]) -> str:
+    if not duration_ms:
+        return "N/A"
+    minutes, seconds = divmod(round(duration_ms / 1000), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def format_search_results(search_results) -> str:
+    """Render candidate videos as the numbered list used in selection prompts."""
+    return "\n".join([
+        f"{idx}: Title: {result.get('title', 'N/A')}\n"
+        f"   Channel: {result.get('channelTitle', 'N/A')}\n"
+        f"   Duration: {_format_duration(result.get('durationMs'))}\n"
+        f"   Published: {result.get('publishedAt', 'N/A')}\n"
+        f"   Description: {result.get('description', 'N/A')[:100]}...\n"
+        for idx, result in enumerate(search_results)
+    ])
+
+
+def _selection_cache_key_for(song_metadata, search_results, use_cache: bool) -> Optional[str]:
+    track_id = song_metadata.get('id')
+    return selection_cache_key(track_id, search_results) if use_cache and track_id else None
+
+
+def _cached_selection(cache_key: Optional[str], search_results) -> Optional[Dict[str, Any]]:
+    if not cache_key:
+        return None
+    cached = get_selection_cache().get(cache_key)
+    if cached is not None and 0 <= cached['index'] < len(search_results):
+        return {"video": search_results[cached['index']], "reason": cached['reason'], "cached": True}
+    return None
+
+
+async def select_best_youtube_video(song_metadata, search_results, use_cache: bool = True):
     """
     Async: Given song metadata and a list of YouTube search results, select the best video that matches the song.
+    Selections are memoized per track id and candidate list, so already resolved tracks skip the LLM.
     Args:
         song_metadata (dict): Song info (title, artist, etc.)
         search_results (list): List of dicts, each with video metadata (title, channel, duration, etc.)
+        use_cache (bool): Serve and store selections in the on-disk selection cache
     Returns:
         dict: The selected video result (from search_results) with selection details
     """
+    cache_key = _selection_cache_key_for(song_metadata, search_results, use_cache)
+    cached = _cached_selection(cache_key, search_results)
+    if cached:
+        return cached
+
     prompt = (
         "Given the following song metadata and YouTube search results, select the video that is most likely to be the correct song (not a music video with extra scenes/dialog, but the song itself). "
-        "Return only the index of the best match.\n"
+        "Return the index of the best match and a short explanation.\n"
         f"Song metadata: {song_metadata}\n"
-        "Search results:\n" +
-        "\n".join([
-            f"{idx}: Title: {result.get('title', 'N/A')}\n"
-            f"   Channel: {result.get('channelTitle', 'N/A')}\n"
-            f"   Published: {result.get('publishedAt', 'N/A')}\n"
-            f"   Description: {result.get('description', 'N/A')[:100]}...\n"
-            for idx, result in enumerate(search_results)
-        ])
+        "Search results:\n" + format_search_results(search_results)
     )
     messages = [
-        {"role": "system", "content": "You are an expert at matching songs to YouTube videos."},
+        {"role": "system", "content": SELECTION_SYSTEM_PROMPT},
         {"role": "user", "content": prompt}
     ]
     
     try:
         result = await chat_completion(messages, response_model=VideoSelection)
         if isinstance(result, VideoSelection) and 0 <= result.index < len(search_results):
-            return {"video": search_results[result.index]}
+            if cache_key:
+                get_selection_cache().set(cache_key, {"index": result.index, "reason": result.reason})
+            return {"video": search_results[result.index], "reason": result.reason}
         else:
             return {"video": None, "error": f"LLM returned invalid index {getattr(result, 'index', None)}. Must be between 0 and {len(search_results)-1}."}
     except Exception as e:
         return {"video": None, "error": f"Failed to get valid selection from LLM: {e}"}
 
 
+async def select_best_youtube_videos_batch(tracks: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+                                           use_cache: bool = True) -> List[Dict[str, Any]]:
+    """
+    Async: Select the best video for several tracks with a single LLM request.
+    Tracks already in the selection cache are answered locally. Any track the batched response
+    leaves out or answers with an out-of-range index falls back to select_best_youtube_video,
+    and so does the whole batch if the response cannot be parsed.
+    Args:
+        tracks (list): (song_metadata, search_results) pairs, as passed to select_best_youtube_video
+        use_cache (bool): Serve and store selections in the on-disk selection cache
+    Returns:
+        list: One selection dict per track, in input order, shaped like select_best_youtube_video's result
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(tracks)
+    cache_keys = [_selection_cache_key_for(meta, candidates, use_cache) for meta, candidates in tracks]
+    pending: List[int] = []
+    for i, (meta, candidates) in enumerate(tracks):
+        cached = _cached_selection(cache_keys[i], candidates)
+        if cached:
+            results[i] = cached
+        elif candidates:
+            pending.append(i)
+        else:
+            results[i] = {"video": None, "error": "No search results to select from."}
+
+    if len(pending) == 1:
+        meta, candidates = tracks[pending[0]]
+        results[pending[0]] = await select_best_youtube_video(meta, candidates, use_cache)
+        pending = []
+
+    if pending:
+        prompt = (
+            "For each of the following songs, select the YouTube video that is most likely to be the correct song (not a music video with extra scenes/dialog, but the song itself). "
+            "Return exactly one selection per track with the track number, the index of the best match within that track's search results, and a short explanation.\n\n" +
+            "\n".join(
+                f"Track {n}:\nSong metadata: {tracks[i][0]}\nSearch results:\n{format_search_results(tracks[i][1])}"
+                for n, i in enumerate(pending)
+            )
+        )
+        messages = [
+            {"role": "system", "content": SELECTION_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+        try:
+            batch = await chat_completion(messages, response_model=BatchVideoSelection)
+            selections = batch.selections if isinstance(batch, BatchVideoSelection) else []
+        except Exception:
+            selections = []
+
+        for selection in selections:
+            if not 0 <= selection.track < len(pending):
+                continue
+            i = pending[selection.track]
+            candidates = tracks[i][1]
+            if results[i] is not None or not 0 <= selection.index < len(candidates):
+                continue
+            if cache_keys[i]:
+                get_selection_cache().set(cache_keys[i], {"index": selection.index, "reason": selection.reason})
+            results[i] = {"video": candidates[selection.index], "reason": selection.reason}
+
+    # Per-track fallback for anything the batch did not resolve
+    missing = [i for i in pending if results[i] is None]
+    if missing:
+        fallbacks = await asyncio.gather(*(
+            select_best_youtube_video(tracks[i][0], tracks[i][1], use_cache) for i in missing
+        ))
+        for i, result in zip(missing, fallbacks):
+            results[i] = result
+
+    return [result for result in results if result is not None]
+
+
 if __name__ == "__main__":
     # Example async usage
     async def main():
@@ -0,0 +1,123 @@
+"""
+Download Manifest
+-----------------
+Records what has already been downloaded and tagged for each Spotify track, so a
+playlist sync only does work for tracks that are new or changed.
+
+For every track id the manifest keeps the chosen videoId, the output path, the
+file size and a hash of the metadata that was written into the tags. Comparing a
+playlist against it sorts every track into one of three buckets:
+
+    - 'new':       never downloaded, moved to a new path, or the file is missing/changed
+    - 'retag':     file is intact but the Spotify metadata changed since it was tagged
+    - 'unchanged': nothing to do
+
+Classes:
+    - ManifestEntry
+    - DownloadManifest
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+from spotify_api import SpotifyTrack
+
+MANIFEST_FILE_NAME = ".manifest.json"
+
+
+class ManifestEntry(BaseModel):
+    trackId: str
+    videoId: str
+    path: str
+    size: int
+    tagHash: str
+
+
+def track_tag_hash(track: SpotifyTrack) -> str:
+    """Hash of the track metadata that ends up in the file's tags."""
+    payload = json.dumps(track.model_dump(), sort_keys=True).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()
+
+
+class DownloadManifest:
+    def __init__(self, path: str, entries: Optional[Dict[str, ManifestEntry]] = None) -> None:
+        self.path = path
+        self.entries: Dict[str, ManifestEntry] = entries or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "DownloadManifest":
+        """Load a manifest from disk, or start an empty one if the file does not exist."""
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, "r") as file:
+            data = json.load(file)
+        return cls(path, {track_id: ManifestEntry(**entry) for track_id, entry in data.items()})
+
+    @classmethod
+    def for_output_path(cls, output_path: str) -> "DownloadManifest":
+        """Load the manifest that lives alongside the downloads in ``output_path``."""
+        return cls.load(os.path.join(output_path, MANIFEST_FILE_NAME))
+
+    def save(self) -> None:
+        """Write the manifest atomically so an interrupted run never leaves it half written."""
+        with self._lock:
+            data = {track_id: entry.model_dump() for track_id, entry in self.entries.items()}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record(self, track: SpotifyTrack, video_id: str, path: str) -> None:
+        """Record a track whose file at ``path`` has just been downloaded and tagged."""
+        entry = ManifestEntry(
+            trackId=track.id,
+            videoId=video_id,
+            path=path,
+            size=os.path.getsize(path),
+            tagHash=track_tag_hash(track),
+        )
+        with self._lock:
+            self.entries[track.id] = entry
+
+    def status(self, track: SpotifyTrack, expected_stem: str, extension: Optional[str] = None) -> str:
+        """
+        Decide what a sync needs to do for a track.
+
+        Args:
+            track (SpotifyTrack): Track from the current playlist
+            expected_stem (str): Where the track's file should be, without its extension
+            extension (str, optional): Required file extension, e.g. 'mp3'. None accepts any,
+                since native-container downloads pick theirs at download time
+
+        Returns:
+            str: 'new', 'retag' or 'unchanged'
+        """
+        entry = self.entries.get(track.id)
+        if entry is None:
+            return 'new'
+        stem, suffix = os.path.splitext(entry.path)
+        if stem != expected_stem or (extension and suffix.lower() != f".{extension}"):
+            return 'new'
+        try:
+            if os.path.getsize(entry.path) != entry.size:
+                return 'new'
+        except OSError:
+            return 'new'
+        if entry.tagHash != track_tag_hash(track):
+            return 'retag'
+        return 'unchanged'
+
+    def get(self, track_id: str) -> Optional[ManifestEntry]:
+        return self.entries.get(track_id)
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,137 @@
+"""
+Local Match Scoring
+-------------------
+Fast heuristic scoring of YouTube candidates against a Spotify track, used to
+resolve obvious matches without asking the LLM.
+
+Each candidate gets a score in [0, 1] built from:
+    - how many of the track-name tokens appear in the video title
+    - whether the track artists appear in the title or channel name
+    - channel signals (official "Artist - Topic" and VEVO uploads)
+    - the difference between the video duration and SpotifyTrack.durationMs
+
+An unknown duration scores 0 rather than being left out, so a candidate without
+one can never clear DEFAULT_MATCH_THRESHOLD on name and channel signals alone;
+an official music video upload can be a different cut of the song.
+
+Videos that look like covers, live versions, remixes and similar are penalized
+unless the Spotify track name says the same thing.
+
+Functions:
+    - normalize_tokens
+    - score_candidates
+    - best_local_match
+"""
+
+import re
+import unicodedata
+from typing import List, Optional, Sequence, Set, Tuple
+
+from spotify_api import SpotifyTrack
+from youtube_api import YouTubeSearchResult
+
+DEFAULT_MATCH_THRESHOLD = 0.85
+
+# Weights of each signal, summing to 1
+TITLE_WEIGHT = 0.40
+ARTIST_WEIGHT = 0.25
+CHANNEL_WEIGHT = 0.15
+DURATION_WEIGHT = 0.20
+
+# Durations within this many seconds count as a perfect match, beyond the limit as no match
+DURATION_TOLERANCE_S = 2
+DURATION_LIMIT_S = 15
+
+VARIANT_PENALTY = 0.5
+VARIANT_TOKENS = {
+    "live", "cover", "remix", "karaoke", "instrumental", "acoustic", "reaction",
+    "nightcore", "sped", "slowed", "reverb", "8d", "edit", "mashup", "tutorial", "lesson",
+}
+# Words that add nothing to the match and would otherwise lower title recall
+STOP_TOKENS = {"the", "a", "an", "feat", "ft", "featuring", "official", "audio", "video", "lyrics", "lyric", "hd"}
+
+
+def normalize_tokens(text: str) -> Set[str]:
+    """Lowercase, strip accents and punctuation, and split text into a set of tokens."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return set(re.findall(r"\w+", text)) - STOP_TOKENS
+
+
+def _recall(wanted: Set[str], found: Set[str]) -> float:
+    if not wanted:
+        return 0.0
+    return len(wanted & found) / len(wanted)
+
+
+def _duration_score(track_ms: int, video_ms: int) -> float:
+    diff_s = abs(track_ms - video_ms) / 1000
+    if diff_s <= DURATION_TOLERANCE_S:
+        return 1.0
+    if diff_s >= DURATION_LIMIT_S:
+        return 0.0
+    return 1.0 - (diff_s - DURATION_TOLERANCE_S) / (DURATION_LIMIT_S - DURATION_TOLERANCE_S)
+
+
+def score_candidates(track: SpotifyTrack, candidates: Sequence[YouTubeSearchResult]) -> List[float]:
+    """
+    Score every candidate video for a track in one pass.
+
+    Args:
+        track (SpotifyTrack): Track being matched
+        candidates (Sequence[YouTubeSearchResult]): Search results for the track
+
+    Returns:
+        List[float]: One score in [0, 1] per candidate, in the same order
+    """
+    name_tokens = normalize_tokens(track.name)
+    artist_token_sets = [normalize_tokens(artist.name) for artist in track.artists]
+    artist_tokens = set().union(*artist_token_sets) if artist_token_sets else set()
+    allowed_variants = name_tokens & VARIANT_TOKENS
+
+    scores = []
+    for candidate in candidates:
+        title_tokens = normalize_tokens(candidate.title)
+        channel = candidate.channelTitle.casefold()
+        channel_tokens = normalize_tokens(candidate.channelTitle)
+
+        title_score = _recall(name_tokens, title_tokens)
+        artist_score = _recall(artist_tokens, title_tokens | channel_tokens)
+
+        channel_score = 0.0
+        if channel.endswith(" - topic"):
+            channel_score = 1.0
+        elif "vevo" in channel or (artist_tokens and artist_tokens <= channel_tokens):
+            channel_score = 0.8
+
+        video_ms = getattr(candidate, "durationMs", None)
+        duration_score = _duration_score(track.durationMs, video_ms) if video_ms else 0.0
+
+        score = (TITLE_WEIGHT * title_score + ARTIST_WEIGHT * artist_score
+                 + CHANNEL_WEIGHT * channel_score + DURATION_WEIGHT * duration_score)
+        if (title_tokens - name_tokens) & (VARIANT_TOKENS - allowed_variants):
+            score *= VARIANT_PENALTY
+        scores.append(score)
+    return scores
+
+
+def best_local_match(track: SpotifyTrack, candidates: Sequence[YouTubeSearchResult],
+                     threshold: float = DEFAULT_MATCH_THRESHOLD) -> Optional[Tuple[int, float]]:
+    """
+    Return (index, score) of the best candidate if it clears ``threshold``, otherwise None.
+
+    Args:
+        track (SpotifyTrack): Track being matched
+        candidates (Sequence[YouTubeSearchResult]): Search results for the track
+        threshold (float): Minimum score for a match to be trusted without the LLM
+
+    Returns:
+        Optional[Tuple[int, float]]: Index and score of the confident match, if any
+    """
+    if not candidates:
+        return None
+    scores = score_candidates(track, candidates)
+    best = max(range(len(scores)), key=scores.__getitem__)
+    if scores[best] < threshold:
+        return None
+    return best, scores[best]
@@ -0,0 +1,206 @@
+"""
+Media Store
+-----------
+Content-addressed store of finished downloads, keyed by YouTube video id and format profile.
+
+The first time a video is needed in a given profile (see download_util.format_profile)
+it is downloaded and transcoded as usual and a copy of the untagged result is kept
+under ``MEDIA_STORE_DIR/<profile>/<videoId>.<ext>``. Every later request for the same
+video, from another playlist, another track the same video was picked for, or a
+later run, is served by copying the stored file into place with no network or
+ffmpeg work at all.
+
+Files are placed with a reflink (copy-on-write clone) where the filesystem supports
+it, so a placed copy costs no extra disk until it is modified. Tags are written into
+placed files in place, so writable copies never share an inode with the store;
+read-only consumers can ask for a hardlink instead. Without reflink support a
+writable copy is a plain file copy.
+
+The store is bounded to MEDIA_STORE_MAX_BYTES (default 2 GB). Placing a file marks
+it as used, and adding a file evicts the least recently used ones beyond the bound,
+the way SqliteCache bounds its entries. Without reflink support every stored file is
+a second copy of a library file, so the bound is also the most extra disk it costs.
+
+Jobs in one event loop that want the same key at the same time are coalesced:
+the first one claims the key and produces the file, the rest wait for it and are
+then served from the store.
+
+Classes:
+    - MediaStore
+
+Functions:
+    - place_file
+"""
+
+import asyncio
+import glob
+import os
+import shutil
+import threading
+from typing import Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, where files are always copied
+    fcntl = None
+
+MEDIA_STORE_DIR = os.getenv("MEDIA_STORE_DIR", ".cache/media")
+MEDIA_STORE_MAX_BYTES = int(os.getenv("MEDIA_STORE_MAX_BYTES", 2 * 1024 ** 3))
+
+# ioctl request cloning one file's extents into another (Linux btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(source: str, destination: str) -> bool:
+    """Clone ``source`` into ``destination`` copy-on-write. Returns False where the filesystem can't."""
+    if fcntl is None:
+        return False
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+def place_file(source: str, destination: str, writable: bool = True) -> str:
+    """
+    Put a copy of ``source`` at ``destination``, replacing whatever is there, as cheaply as possible.
+
+    Args:
+        source (str): Existing file
+        destination (str): Target path, its directory is created if missing
+        writable (bool): If False a hardlink is allowed, so ``destination`` must never be modified in place
+
+    Returns:
+        str: How the file was placed, 'reflink', 'hardlink' or 'copy'
+    """
+    directory = os.path.dirname(destination)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Build the copy next to the target and swap it in, so readers never see a partial file
+    temp_path = os.path.join(directory, f".{os.path.basename(destination)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    if _reflink(source, temp_path):
+        method = 'reflink'
+    else:
+        method = 'copy'
+        if not writable:
+            try:
+                os.link(source, temp_path)
+                method = 'hardlink'
+            except OSError:
+                pass
+        if method == 'copy':
+            shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+    return method
+
+
+class MediaStore:
+    def __init__(self, root: str = MEDIA_STORE_DIR, max_bytes: Optional[int] = MEDIA_STORE_MAX_BYTES) -> None:
+        """
+        Args:
+            root (str): Store directory, created on first write
+            max_bytes (int, optional): LRU size bound. None means unbounded
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def path(self, video_id: str, profile: str) -> Optional[str]:
+        """Stored file for a video in a profile, or None if it has not been stored yet."""
+        matches = glob.glob(os.path.join(self.root, profile, f"{glob.escape(video_id)}.*"))
+        return matches[0] if matches else None
+
+    def add(self, video_id: str, profile: str, source: str) -> str:
+        """
+        Keep a copy of a freshly produced file. ``source`` stays where it is and may be tagged afterwards.
+
+        Returns:
+            str: Path of the stored file
+        """
+        extension = os.path.splitext(source)[1]
+        stored = os.path.join(self.root, profile, f"{video_id}{extension}")
+        place_file(source, stored)
+        self._evict(keep=stored)
+        return stored
+
+    def _evict(self, keep: str) -> None:
+        """Delete the least recently used files until the store fits in max_bytes, sparing ``keep``."""
+        if self.max_bytes is None:
+            return
+        with self._evict_lock:
+            files = []
+            for profile in os.scandir(self.root):
+                if profile.is_dir():
+                    # Dot-files are copies still being written by place_file
+                    files.extend(entry for entry in os.scandir(profile.path)
+                                 if entry.is_file() and not entry.name.startswith('.'))
+            stats = [(entry.path, entry.stat()) for entry in files]
+            total = sum(stat.st_size for _, stat in stats)
+            for path, stat in sorted(stats, key=lambda item: item[1].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= stat.st_size
+
+    def place(self, video_id: str, profile: str, directory: str, file_name: str,
+              writable: bool = True) -> Optional[str]:
+        """
+        Copy a stored video into ``directory`` as ``file_name`` plus the stored file's extension.
+
+        Args:
+            video_id (str): YouTube video id
+            profile (str): Format profile the file was stored under
+            directory (str): Target directory, created if missing
+            file_name (str): Target name without extension
+            writable (bool): See place_file
+
+        Returns:
+            Optional[str]: Path of the placed file, or None if the video is not stored
+        """
+        stored = self.path(video_id, profile)
+        if stored is None:
+            return None
+        destination = os.path.join(directory, f"{file_name}{os.path.splitext(stored)[1]}")
+        try:
+            # The modification time doubles as the last-used time for eviction
+            os.utime(stored)
+            place_file(stored, destination, writable)
+        except FileNotFoundError:
+            # Evicted between the lookup and the copy
+            return None
+        return destination
+
+    async def claim(self, video_id: str, profile: str) -> bool:
+        """
+        Decide who produces a video. Waits while another job in this event loop is producing it.
+
+        Returns:
+            bool: True if the caller now owns the key and must produce the file, then call release();
+            False if the file is stored and can be placed
+        """
+        key = (video_id, profile)
+        while True:
+            if self.path(video_id, profile) is not None:
+                return False
+            pending = self._inflight.get(key)
+            if pending is None:
+                self._inflight[key] = asyncio.get_running_loop().create_future()
+                return True
+            # Shielded so a cancelled waiter doesn't cancel the future the other waiters share
+            await asyncio.shield(pending)
+
+    def release(self, video_id: str, profile: str) -> None:
+        """Give up ownership of a key, stored or not, and wake the jobs waiting for it."""
+        pending = self._inflight.pop((video_id, profile), None)
+        if pending is not None and not pending.done():
+            pending.set_result(None)
@@ -0,0 +1,244 @@
+"""
+Metrics
+-------
+Lightweight, thread-safe run metrics shared by every module, with Prometheus text
+export and an end-of-run summary table.
+
+All series carry a single ``stage`` label. Stages are named '<area>.<step>', for
+example 'youtube.search', 'llm.chat', 'ytdlp.download', 'id3.save' or
+'pipeline.download'.
+
+Series:
+    - freemium_stage_seconds        histogram of per-call latency
+    - freemium_stage_errors_total   counter of failed calls
+    - freemium_download_bytes_total counter of bytes received by yt-dlp
+    - freemium_tracks_total         counter of finished tracks, labelled by status
+    - freemium_queue_depth          gauge of jobs waiting in each pipeline queue
+
+Functions:
+    - timer
+    - record_error
+    - add_bytes
+    - download_bytes
+    - count_track
+    - set_queue_depth
+    - render_prometheus
+    - write_prometheus
+    - start_metrics_server
+    - print_summary
+"""
+
+import bisect
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# Histogram bucket upper bounds in seconds, from ID3 writes to long downloads
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Latency samples kept per stage for the summary percentiles, so memory stays flat in long processes
+RESERVOIR_SIZE = 1024
+
+_lock = threading.Lock()
+_started_at = time.time()
+_histograms: Dict[str, dict] = {}
+_errors: Dict[str, int] = {}
+_tracks: Dict[str, int] = {}
+_queue_depth: Dict[str, int] = {}
+_download_bytes = 0
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Record one call's latency for a stage."""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0, "samples": []}
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            histogram["buckets"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        # Reservoir sampling: a uniform random sample of every call so far, for the summary percentiles
+        samples = histogram["samples"]
+        if len(samples) < RESERVOIR_SIZE:
+            samples.append(seconds)
+        else:
+            slot = random.randrange(histogram["count"])
+            if slot < RESERVOIR_SIZE:
+                samples[slot] = seconds
+
+
+@contextmanager
+def timer(stage: str):
+    """Time the wrapped block as one call of ``stage``; exceptions also count as errors."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record_error(stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def record_error(stage: str) -> None:
+    with _lock:
+        _errors[stage] = _errors.get(stage, 0) + 1
+
+
+def add_bytes(count: int) -> None:
+    global _download_bytes
+    with _lock:
+        _download_bytes += count
+
+
+def download_bytes() -> int:
+    """Total bytes received by yt-dlp so far."""
+    with _lock:
+        return _download_bytes
+
+
+def count_track(status: str) -> None:
+    with _lock:
+        _tracks[status] = _tracks.get(status, 0) + 1
+
+
+def set_queue_depth(stage: str, depth: int) -> None:
+    with _lock:
+        _queue_depth[stage] = depth
+
+
+def reset() -> None:
+    """Clear every series and restart the run clock."""
+    global _download_bytes, _started_at
+    with _lock:
+        _histograms.clear()
+        _errors.clear()
+        _tracks.clear()
+        _queue_depth.clear()
+        _download_bytes = 0
+        _started_at = time.time()
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def render_prometheus() -> str:
+    """Render every series in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        lines.append("# HELP freemium_stage_seconds Latency of each call, by stage.")
+        lines.append("# TYPE freemium_stage_seconds histogram")
+        for stage, histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                cumulative += count
+                lines.append(f'freemium_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'freemium_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'freemium_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'freemium_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+        lines.append("# HELP freemium_stage_errors_total Failed calls, by stage.")
+        lines.append("# TYPE freemium_stage_errors_total counter")
+        for stage, count in sorted(_errors.items()):
+            lines.append(f'freemium_stage_errors_total{{stage="{stage}"}} {count}')
+
+        lines.append("# HELP freemium_download_bytes_total Bytes received by yt-dlp.")
+        lines.append("# TYPE freemium_download_bytes_total counter")
+        lines.append(f"freemium_download_bytes_total {_download_bytes}")
+
+        lines.append("# HELP freemium_tracks_total Tracks finished by the pipeline, by status.")
+        lines.append("# TYPE freemium_tracks_total counter")
+        for status, count in sorted(_tracks.items()):
+            lines.append(f'freemium_tracks_total{{status="{status}"}} {count}')
+
+        lines.append("# HELP freemium_queue_depth Jobs waiting in front of each pipeline stage.")
+        lines.append("# TYPE freemium_queue_depth gauge")
+        for stage, depth in sorted(_queue_depth.items()):
+            lines.append(f'freemium_queue_depth{{stage="{stage}"}} {depth}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str) -> None:
+    """Write the current metrics to ``path``, e.g. for the node_exporter textfile collector."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics on http://host:port/ from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics served at http://{host}:{port}/metrics")
+    return server
+
+
+def summary() -> Dict[str, dict]:
+    """
+    Per-stage count, error count and p50/p99/mean latency, plus run throughput:
+    'tracks_per_minute' counts successful tracks, 'finished_per_minute' failed ones too.
+    Percentiles are exact up to RESERVOIR_SIZE calls per stage and estimated from a random sample beyond that.
+    """
+    with _lock:
+        elapsed = max(time.time() - _started_at, 1e-9)
+        stages = {
+            stage: {
+                "count": histogram["count"],
+                "errors": _errors.get(stage, 0),
+                "mean": histogram["sum"] / histogram["count"] if histogram["count"] else 0.0,
+                "p50": _percentile(histogram["samples"], 0.50),
+                "p99": _percentile(histogram["samples"], 0.99),
+            }
+            for stage, histogram in _histograms.items()
+        }
+        finished = sum(_tracks.values())
+        return {
+            "stages": stages,
+            "elapsed": elapsed,
+            "bytes_per_second": _download_bytes / elapsed,
+            # Throughput counts only tracks that made it to a tagged file, as the benchmark does
+            "tracks_per_minute": _tracks.get("success", 0) / elapsed * 60,
+            "finished_per_minute": finished / elapsed * 60,
+        }
+
+
+def print_summary(metrics_path: Optional[str] = None) -> None:
+    """Print the end-of-run table and optionally write the Prometheus file."""
+    data = summary()
+    print("\n" + "=" * 72)
+    print("📈 STAGE METRICS")
+    print("=" * 72)
+    print(f"{'stage':<22}{'calls':>8}{'errors':>8}{'mean s':>10}{'p50 s':>10}{'p99 s':>10}")
+    for stage, row in sorted(data["stages"].items()):
+        print(f"{stage:<22}{row['count']:>8}{row['errors']:>8}{row['mean']:>10.3f}{row['p50']:>10.3f}{row['p99']:>10.3f}")
+    print("-" * 72)
+    print(f"⏱️  Elapsed: {data['elapsed']:.1f}s | "
+          f"🎵 {data['tracks_per_minute']:.1f} tracks/min | "
+          f"🏁 {data['finished_per_minute']:.1f} finished/min incl. failures | "
+          f"⬇️  {data['bytes_per_second'] / 1e6:.2f} MB/s")
+    if metrics_path:
+        write_prometheus(metrics_path)
+        print(f"📝 Prometheus metrics written to {metrics_path}")
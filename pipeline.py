@@ -0,0 +1,438 @@
+"""
+Playlist Download Pipeline
+--------------------------
+Concurrent, staged pipeline that turns Spotify tracks into tagged audio files.
+
+Each track flows through four stages connected by bounded asyncio queues:
+
+    search -> enrich -> select -> download -> transcode -> tag
+
+Every stage runs its own pool of workers with an independent concurrency limit,
+so YouTube searches, LLM selections, yt-dlp downloads, ffmpeg and ID3 writes all
+overlap. Total run time is bounded by the slowest stage instead of the sum of all
+of them. Blocking calls are pushed to threads with ``asyncio.to_thread``, except
+ffmpeg transcoding which runs on a process pool sized to the CPU cores.
+
+When a DownloadManifest is passed in, the run becomes an incremental sync: tracks
+that are already downloaded and tagged are skipped, tracks whose metadata changed
+go straight to the tag stage, and only new tracks are searched and downloaded.
+
+With the media store enabled every video is downloaded and transcoded at most once
+per format: a track whose selected video is already stored, or is being produced
+for another track right now, is copied into place from the store and skips the
+download and transcode work, see media_store.
+
+Functions:
+    - run_playlist_pipeline
+"""
+
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+import metrics
+from download_util import download_single_video, format_profile, get_format_options, new_transcode_pool, transcode_file
+from id3_utils import AudioFile
+from manifest import DownloadManifest
+from match_scoring import DEFAULT_MATCH_THRESHOLD, best_local_match
+from media_store import MEDIA_STORE_DIR, MediaStore
+from search_backends import SearchBackend, get_search_backend
+from llm_chat import select_best_youtube_video, select_best_youtube_videos_batch
+from spotify_api import SpotifyTrack
+from youtube_api import QuotaExceededError, YouTubeSearchResult, enrich_with_durations, get_quota_tracker, get_search_cache
+
+
+class PipelineConfig(BaseModel):
+    """Concurrency and queue settings for each pipeline stage."""
+    output_path: str = "downloads"
+    search_workers: int = 4
+    # 'data_api', 'ytdlp' (no quota) or 'auto' (Data API until its quota is spent), see search_backends
+    search_backend: str = "data_api"
+    # What searches do once the daily YouTube quota is spent: 'stop' fails them right away,
+    # 'pause' waits for the quota to reset at midnight Pacific time
+    quota_policy: str = "stop"
+    # Look up candidate durations in batches of up to this many tracks; 0 disables enrichment
+    enrich_batch_size: int = 10
+    select_workers: int = 4
+    # Tracks packed into one LLM request by each select worker; 1 disables batching
+    select_batch_size: int = 1
+    # Skip the LLM when the local scorer is at least this confident; None disables local matching
+    local_match_threshold: Optional[float] = DEFAULT_MATCH_THRESHOLD
+    download_workers: int = 3
+    # 'mp3' transcodes to MP3; 'native' keeps the original Opus/M4A stream without re-encoding
+    audio_format: str = "mp3"
+    # ffmpeg worker processes; None uses one per CPU core
+    transcode_workers: Optional[int] = None
+    tag_workers: int = 2
+    # Keep finished downloads in this content-addressed store and reuse them for repeat videos;
+    # None downloads every track separately. Without reflink support (ext4, NTFS, APFS) each stored
+    # file is a second copy on disk, up to MEDIA_STORE_MAX_BYTES (2 GB by default) in total
+    media_store_path: Optional[str] = MEDIA_STORE_DIR
+    # Where a selected video is downloaded from; {video_id} is replaced with its id
+    video_url_template: str = "https://www.youtube.com/watch?v={video_id}"
+    queue_size: int = 16
+    max_results: int = 5
+    # Write Prometheus text metrics here at the end of the run, and/or serve them on this local port
+    metrics_path: Optional[str] = None
+    metrics_port: Optional[int] = None
+
+
+class TrackJob(BaseModel):
+    """State of a single track as it moves through the pipeline."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    index: int
+    track: SpotifyTrack
+    query: str = ""
+    search_results: List[YouTubeSearchResult] = []
+    video: Optional[YouTubeSearchResult] = None
+    # How the video was chosen: 'local', 'cache' or 'llm'
+    selected_by: str = ""
+    output_file: Optional[str] = None
+    # Placed from the media store instead of downloaded, so there is nothing to transcode
+    reused: bool = False
+    # This job claimed its video in the media store and must release it
+    owns_media: bool = False
+    success: bool = False
+    message: str = ""
+
+
+# Sentinel pushed through a queue once per downstream worker to shut it down
+_STOP = object()
+
+
+def track_output_stem(track: SpotifyTrack, config: PipelineConfig) -> str:
+    """
+    Path a track is downloaded to, without its extension.
+    The extension depends on the audio format and, in native mode, on the source stream;
+    the download and transcode stages report the real path.
+    """
+    return os.path.join(config.output_path, track.album.name, track.name)
+
+
+def build_query(track: SpotifyTrack) -> str:
+    """Build the YouTube search query for a Spotify track."""
+    return f"{track.name} {' '.join(artist.name for artist in track.artists)}"
+
+
+async def _search_stage(job: TrackJob, config: PipelineConfig, backend: SearchBackend) -> bool:
+    job.query = build_query(job.track)
+    print(f"🔍 [{job.index}] Searching for: {job.query}")
+    while True:
+        try:
+            job.search_results = await backend.search_async(job.query, config.max_results)
+            break
+        except QuotaExceededError as e:
+            if config.quota_policy != "pause":
+                job.message = f"❌ [{job.index}] {e}"
+                return False
+            wait = get_quota_tracker().seconds_until_reset() + 60
+            print(f"⏸️  [{job.index}] YouTube quota spent, pausing this search for {wait / 3600:.1f}h until it resets")
+            await asyncio.sleep(wait)
+    if not job.search_results:
+        job.message = f"No YouTube results found for: {job.query}"
+        return False
+    return True
+
+
+async def _enrich_stage(jobs: List[TrackJob], config: PipelineConfig) -> List[bool]:
+    await asyncio.to_thread(enrich_with_durations, [job.search_results for job in jobs])
+    return [True] * len(jobs)
+
+
+def _select_locally(job: TrackJob, config: PipelineConfig) -> bool:
+    if config.local_match_threshold is None:
+        return False
+    match = best_local_match(job.track, job.search_results, config.local_match_threshold)
+    if match is None:
+        return False
+    job.video = job.search_results[match[0]]
+    job.selected_by = 'local'
+    return True
+
+
+def _apply_selection(job: TrackJob, best_video) -> bool:
+    if not best_video or not best_video.get('video'):
+        reason = best_video.get('error') if best_video else 'Unknown error'
+        job.message = f"No suitable video found for: {job.query} Reason: {reason}"
+        return False
+    job.video = YouTubeSearchResult(**best_video['video'])
+    job.selected_by = 'cache' if best_video.get('cached') else 'llm'
+    return True
+
+
+async def _select_stage(job: TrackJob, config: PipelineConfig) -> bool:
+    if _select_locally(job, config):
+        return True
+    candidates = [result.model_dump() for result in job.search_results]
+    best_video = await select_best_youtube_video(job.track.model_dump(), candidates)
+    return _apply_selection(job, best_video)
+
+
+async def _select_batch_stage(jobs: List[TrackJob], config: PipelineConfig) -> List[bool]:
+    passed = [_select_locally(job, config) for job in jobs]
+    remaining = [i for i, ok in enumerate(passed) if not ok]
+    if remaining:
+        selections = await select_best_youtube_videos_batch([
+            (jobs[i].track.model_dump(), [result.model_dump() for result in jobs[i].search_results])
+            for i in remaining
+        ])
+        for i, best_video in zip(remaining, selections):
+            passed[i] = _apply_selection(jobs[i], best_video)
+    return passed
+
+
+async def _download_stage(job: TrackJob, config: PipelineConfig, store: Optional[MediaStore]) -> bool:
+    assert job.video is not None
+    album_path = os.path.dirname(track_output_stem(job.track, config))
+    if store is not None:
+        profile = format_profile(True, config.audio_format)
+        # Waits here while another job produces the same video. That job is already downloading or
+        # transcoding and never needs this stage's workers again, so waiting can't deadlock
+        if await store.claim(job.video.videoId, profile):
+            job.owns_media = True
+        else:
+            job.output_file = await asyncio.to_thread(
+                store.place, job.video.videoId, profile, album_path, job.track.name)
+            if job.output_file is not None:
+                job.reused = True
+                print(f"♻️  [{job.index}] Reusing stored download: {job.video.title}")
+                return True
+    try:
+        downloaded = await _download(job, config, album_path)
+    finally:
+        if job.owns_media and not job.output_file:
+            _release_media(job, config, store)
+    return downloaded
+
+
+def _release_media(job: TrackJob, config: PipelineConfig, store: MediaStore) -> None:
+    store.release(job.video.videoId, format_profile(True, config.audio_format))
+    job.owns_media = False
+
+
+async def _download(job: TrackJob, config: PipelineConfig, album_path: str) -> bool:
+    print(f"⬇️  [{job.index}] Downloading: {job.video.title}")
+    result = await asyncio.to_thread(
+        download_single_video,
+        config.video_url_template.format(video_id=job.video.videoId),
+        output_path=album_path,
+        file_name=job.track.name,
+        thread_id=job.index,
+        audio_only=True,
+        audio_format=config.audio_format,
+        postprocess=False,
+        content_type='video',
+        reuse_downloader=True,
+    )
+    if not result["success"]:
+        job.message = result["message"]
+        return False
+    if not result.get("files"):
+        job.message = f"❌ [{job.index}] Download reported success but produced no file"
+        return False
+    job.output_file = result["files"][-1]
+    return True
+
+
+async def _transcode_stage(job: TrackJob, config: PipelineConfig, pool: ProcessPoolExecutor,
+                           store: Optional[MediaStore]) -> bool:
+    assert job.output_file is not None
+    if job.reused:
+        return True
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(pool, transcode_file, job.output_file, True, config.audio_format)
+        metrics.observe("ffmpeg.transcode", result["seconds"])
+        if not result["success"]:
+            metrics.record_error("ffmpeg.transcode")
+            job.message = result["message"]
+            return False
+        job.output_file = result["filepath"]
+        if job.owns_media:
+            # Store the untagged file before the tag stage writes into it
+            await asyncio.to_thread(store.add, job.video.videoId, format_profile(True, config.audio_format),
+                                    job.output_file)
+        return True
+    finally:
+        if job.owns_media:
+            _release_media(job, config, store)
+
+
+def _tag_file(path: str, track: SpotifyTrack) -> None:
+    audio = AudioFile(path)
+    audio.modify_metadata(track)
+
+
+async def _tag_stage(job: TrackJob, config: PipelineConfig) -> bool:
+    assert job.output_file is not None
+    await asyncio.to_thread(_tag_file, job.output_file, job.track)
+    job.success = True
+    job.message = f"✅ [{job.index}] {job.track.name} saved to {job.output_file}"
+    return True
+
+
+async def _next_batch(inbox: asyncio.Queue, batch_size: int):
+    """Wait for one job, then take up to ``batch_size - 1`` more that are already queued."""
+    batch: List[TrackJob] = []
+    item = await inbox.get()
+    inbox.task_done()
+    while item is not _STOP:
+        batch.append(item)
+        if len(batch) >= batch_size or inbox.empty():
+            return batch, False
+        item = inbox.get_nowait()
+        inbox.task_done()
+    return batch, True
+
+
+async def _stage_worker(stage, config: PipelineConfig, inbox: asyncio.Queue,
+                        outbox: Optional[asyncio.Queue], done: List[TrackJob],
+                        batch_size: Optional[int] = None) -> None:
+    """
+    Pull jobs from ``inbox``, run ``stage`` and forward successful jobs to ``outbox``.
+    With a ``batch_size`` the stage receives a list of up to that many jobs and returns one flag per job.
+    """
+    stage_name = getattr(stage, 'func', stage).__name__.strip('_')
+    metric_name = f"pipeline.{stage_name.removesuffix('_stage')}"
+    while True:
+        batch, stop = await _next_batch(inbox, batch_size or 1)
+        metrics.set_queue_depth(metric_name, inbox.qsize())
+        if batch:
+            start = time.perf_counter()
+            try:
+                if batch_size:
+                    passed = await stage(batch, config)
+                else:
+                    passed = [await stage(batch[0], config)]
+            except Exception as e:
+                for job in batch:
+                    job.message = f"❌ [{job.index}] {stage_name} failed: {e}"
+                passed = [False] * len(batch)
+            metrics.observe(metric_name, time.perf_counter() - start)
+
+            for job, ok in zip(batch, passed):
+                if ok and outbox is not None:
+                    await outbox.put(job)
+                else:
+                    if not ok:
+                        metrics.record_error(metric_name)
+                        print(job.message)
+                    metrics.count_track('success' if job.success else 'failed')
+                    done.append(job)
+        if stop:
+            return
+
+
+def _record_in_manifest(manifest: DownloadManifest, jobs: List[TrackJob]) -> None:
+    for job in jobs:
+        if not job.success or job.output_file is None:
+            continue
+        entry = manifest.get(job.track.id)
+        video_id = job.video.videoId if job.video else entry.videoId if entry else ""
+        manifest.record(job.track, video_id, job.output_file)
+    manifest.save()
+
+
+async def run_playlist_pipeline(tracks: List[SpotifyTrack],
+                                config: Optional[PipelineConfig] = None,
+                                manifest: Optional[DownloadManifest] = None) -> List[TrackJob]:
+    """
+    Search, select, download and tag a list of tracks concurrently.
+
+    Args:
+        tracks (List[SpotifyTrack]): Tracks to process
+        config (PipelineConfig, optional): Stage concurrency and queue sizes
+        manifest (DownloadManifest, optional): Sync against this manifest and update it
+
+    Returns:
+        List[TrackJob]: Final state of every processed track, in input order.
+        Tracks skipped as unchanged by a sync are not included.
+    """
+    config = config or PipelineConfig()
+    metrics.reset()
+    metrics_server = metrics.start_metrics_server(config.metrics_port) if config.metrics_port else None
+    search_backend = get_search_backend(config.search_backend, config.search_workers)
+    media_store = MediaStore(config.media_store_path) if config.media_store_path else None
+    transcode_pool = new_transcode_pool(config.transcode_workers)
+    batch_select = config.select_batch_size > 1
+    # (stage, workers, batch size or None for stages that take one job at a time)
+    stages = [
+        (functools.partial(_search_stage, backend=search_backend), config.search_workers, None),
+        (_enrich_stage, 1, config.enrich_batch_size),
+        (_select_batch_stage if batch_select else _select_stage, config.select_workers,
+         config.select_batch_size if batch_select else None),
+        (functools.partial(_download_stage, store=media_store), config.download_workers, None),
+        (functools.partial(_transcode_stage, pool=transcode_pool, store=media_store),
+         config.transcode_workers or os.cpu_count() or 1, None),
+        (_tag_stage, config.tag_workers, None),
+    ]
+    # yt-dlp search results already carry durations
+    if config.enrich_batch_size <= 0 or config.search_backend == "ytdlp":
+        stages = [stage for stage in stages if stage[0] is not _enrich_stage]
+    queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=config.queue_size) for _ in stages]
+    done: List[TrackJob] = []
+
+    worker_groups: List[List[asyncio.Task]] = []
+    for i, (stage, workers, batch_size) in enumerate(stages):
+        outbox = queues[i + 1] if i + 1 < len(queues) else None
+        worker_groups.append([
+            asyncio.create_task(_stage_worker(stage, config, queues[i], outbox, done, batch_size))
+            for _ in range(max(1, workers))
+        ])
+
+    try:
+        counts = {'new': 0, 'retag': 0, 'unchanged': 0}
+        # Known up front for MP3; native files keep whatever container the source stream has
+        _, extension, _ = get_format_options(True, config.audio_format)
+        redownloads: List[TrackJob] = []
+        for idx, track in enumerate(tracks):
+            output_stem = track_output_stem(track, config)
+            status = manifest.status(track, output_stem, extension) if manifest is not None else 'new'
+            counts[status] += 1
+            if status == 'new' and manifest is not None and manifest.get(track.id) is not None:
+                # Tracks that were downloaded before wait until never-seen tracks have used the search quota
+                redownloads.append(TrackJob(index=idx, track=track))
+            elif status == 'new':
+                await queues[0].put(TrackJob(index=idx, track=track))
+            elif status == 'retag':
+                await queues[-1].put(TrackJob(index=idx, track=track, output_file=manifest.get(track.id).path))
+        for job in redownloads:
+            await queues[0].put(job)
+        if manifest is not None:
+            print(f"🔁 Sync: {counts['new']} new, {counts['retag']} to re-tag, {counts['unchanged']} unchanged")
+
+        # Shut stages down front to back so every job drains before its consumer stops
+        for queue, group in zip(queues, worker_groups):
+            for _ in group:
+                await queue.put(_STOP)
+            await asyncio.gather(*group)
+    finally:
+        search_backend.close()
+        transcode_pool.shutdown(cancel_futures=True)
+        if manifest is not None:
+            _record_in_manifest(manifest, done)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    done.sort(key=lambda job: job.index)
+    successful = sum(1 for job in done if job.success)
+    print(f"\n📊 Pipeline finished: {successful}/{len(done)} tracks processed successfully")
+    selected = [job for job in done if job.selected_by]
+    if selected:
+        local = sum(1 for job in selected if job.selected_by == 'local')
+        print(f"🧮 Resolved locally: {local}/{len(selected)} ({local / len(selected):.0%}) without the LLM")
+    reused = sum(1 for job in done if job.reused)
+    if reused:
+        print(f"♻️  Media store: {reused} tracks reused a stored download instead of fetching it again")
+    cache_stats = get_search_cache().stats()
+    print(f"🗄️  Search cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    quota = get_quota_tracker()
+    print(f"🎫 YouTube quota: {quota.spent()}/{quota.daily_units} units spent today")
+    metrics.print_summary(config.metrics_path)
+    return done
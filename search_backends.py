@@ -0,0 +1,178 @@
+"""
+Search Backends
+---------------
+Interchangeable ways of finding candidate YouTube videos for a query, selectable per run.
+
+    - 'data_api': the YouTube Data API through youtube_search. Rich metadata, but each
+      search costs 100 of the 10,000 daily quota units
+    - 'ytdlp':    yt-dlp's flat ``ytsearchN:`` extraction. No API key or quota, and
+      durations come with the results, so the enrich stage has nothing to look up
+    - 'auto':     the Data API until the day's quota is spent, then yt-dlp
+
+Every backend returns YouTubeSearchResult lists, runs searches on its own worker
+pool through ``search_async``, and caches results in the shared search cache.
+
+Classes:
+    - SearchBackend
+    - DataApiBackend
+    - YtDlpSearchBackend
+    - FallbackSearchBackend
+
+Functions:
+    - get_search_backend
+"""
+
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from yt_dlp import YoutubeDL
+
+import metrics
+from youtube_api import QuotaExceededError, YouTubeSearchResult, get_search_cache, search_cache_key, youtube_search
+
+SEARCH_BACKENDS = ("data_api", "ytdlp", "auto")
+
+
+class SearchBackend(ABC):
+    """
+    Base class: subclasses implement ``search``; ``search_async`` runs it on the backend's pool.
+    The pool is only started by the first ``search_async``, so backends that are only called
+    through ``search``, like the ones inside FallbackSearchBackend, hold no threads.
+    """
+    name = "base"
+
+    def __init__(self, max_workers: int = 8) -> None:
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=f"search-{self.name}")
+            return self._executor
+
+    @abstractmethod
+    def search(self, query: str, max_results: int = 5, use_cache: bool = True) -> List[YouTubeSearchResult]:
+        """Search synchronously; runs on the caller's thread."""
+
+    async def search_async(self, query: str, max_results: int = 5, use_cache: bool = True) -> List[YouTubeSearchResult]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.search, query, max_results, use_cache)
+
+    def close(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DataApiBackend(SearchBackend):
+    """YouTube Data API search; raises QuotaExceededError once the daily quota is spent."""
+    name = "data_api"
+
+    def search(self, query: str, max_results: int = 5, use_cache: bool = True) -> List[YouTubeSearchResult]:
+        return youtube_search(query, max_results, use_cache)
+
+
+class YtDlpSearchBackend(SearchBackend):
+    """Quota-free search through yt-dlp's flat ``ytsearchN:`` extractor, one YoutubeDL per worker thread."""
+    name = "ytdlp"
+
+    def __init__(self, max_workers: int = 8) -> None:
+        super().__init__(max_workers)
+        self._local = threading.local()
+
+    def _downloader(self) -> YoutubeDL:
+        ydl = getattr(self._local, "ydl", None)
+        if ydl is None:
+            ydl = self._local.ydl = YoutubeDL({
+                'quiet': True,
+                'no_warnings': True,
+                # List the search hits without resolving each video page
+                'extract_flat': 'in_playlist',
+                'skip_download': True,
+            })
+        return ydl
+
+    def search(self, query: str, max_results: int = 5, use_cache: bool = True) -> List[YouTubeSearchResult]:
+        cache_key = f"ytdlp|{search_cache_key(query, max_results)}"
+        if use_cache:
+            cached = get_search_cache().get(cache_key)
+            if cached is not None:
+                return [YouTubeSearchResult(**item) for item in cached]
+
+        try:
+            with metrics.timer("ytdlp.search"):
+                info = self._downloader().extract_info(f"ytsearch{max_results}:{query}", download=False)
+        except Exception as e:
+            print(f"An error occurred during yt-dlp search: {e}")
+            return []
+
+        search_results = [
+            YouTubeSearchResult(
+                title=entry.get('title') or '',
+                videoId=entry['id'],
+                channelTitle=entry.get('channel') or entry.get('uploader') or '',
+                # Flat search entries carry no upload date
+                publishedAt='',
+                description=entry.get('description') or '',
+                durationMs=int(entry['duration'] * 1000) if entry.get('duration') else None,
+            )
+            for entry in (info or {}).get('entries') or []
+            if entry and entry.get('id')
+        ]
+        if use_cache:
+            get_search_cache().set(cache_key, [result.model_dump() for result in search_results])
+        return search_results
+
+
+class FallbackSearchBackend(SearchBackend):
+    """Search with ``primary`` and switch to ``fallback`` for the rest of the run once its quota is spent."""
+    name = "auto"
+
+    def __init__(self, primary: SearchBackend, fallback: SearchBackend, max_workers: int = 8) -> None:
+        super().__init__(max_workers)
+        self.primary = primary
+        self.fallback = fallback
+        self.exhausted = False
+
+    def search(self, query: str, max_results: int = 5, use_cache: bool = True) -> List[YouTubeSearchResult]:
+        if not self.exhausted:
+            try:
+                return self.primary.search(query, max_results, use_cache)
+            except QuotaExceededError:
+                if not self.exhausted:
+                    print(f"🔀 {self.primary.name} quota spent, routing remaining searches to {self.fallback.name}")
+                self.exhausted = True
+        return self.fallback.search(query, max_results, use_cache)
+
+    def close(self) -> None:
+        super().close()
+        self.primary.close()
+        self.fallback.close()
+
+
+def get_search_backend(name: str = "data_api", max_workers: int = 8) -> SearchBackend:
+    """
+    Build the search backend for a run.
+
+    Args:
+        name (str): 'data_api', 'ytdlp' or 'auto', see the module docstring
+        max_workers (int): Searches run concurrently by the backend
+
+    Returns:
+        SearchBackend: Call close() when the run is done
+    """
+    if name == "data_api":
+        return DataApiBackend(max_workers)
+    if name == "ytdlp":
+        return YtDlpSearchBackend(max_workers)
+    if name == "auto":
+        # The wrapper's own pool does the concurrency; the inner backends are called inline and start none
+        return FallbackSearchBackend(DataApiBackend(), YtDlpSearchBackend(), max_workers)
+    raise ValueError(f"Unknown search backend '{name}', expected one of {', '.join(SEARCH_BACKENDS)}")
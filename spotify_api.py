@@ -3,6 +3,8 @@ import pprint
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 from spotipy.client import SpotifyException
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import json
 from pydantic import BaseModel
@@ -34,8 +36,88 @@ class SpotifyPlaylist(BaseModel):
   imageUrl: str | None
   tracks: list[SpotifyTrack]
 
+# Largest page sizes the Web API accepts for each endpoint
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+USER_PLAYLISTS_PAGE_SIZE = 50
+
+
+class IncompletePagesError(RuntimeError):
+    """A paged Web API listing came back with one or more pages missing."""
+
+
+def parse_track(track_info: dict) -> SpotifyTrack:
+    """Build a SpotifyTrack from a Web API track object."""
+    artists = [Artist(id=artist['id'], name=artist['name']) for artist in track_info['artists']]
+    album = Album(
+        id=track_info['album']['id'],
+        name=track_info['album']['name'],
+        artists=[Artist(id=artist['id'], name=artist['name']) for artist in track_info['album']['artists']],
+        imageUrl=track_info['album']['images'][0]['url'] if track_info['album']['images'] else None
+    )
+    return SpotifyTrack(
+        id=track_info['id'],
+        name=track_info['name'],
+        artists=artists,
+        album=album,
+        durationMs=track_info['duration_ms'],
+    )
+
+
+def is_usable_track(item: dict) -> bool:
+    """Local files, podcast episodes and removed tracks have no usable track object."""
+    track_info = item.get('track')
+    return bool(track_info and track_info.get('id') and track_info.get('type', 'track') == 'track')
+
+
+class PlaylistHandle:
+    """
+    A playlist from the user's listing whose tracks are only fetched when accessed.
+
+    Name, track count and snapshot id come from the listing itself. iter_tracks() pages
+    through the tracks lazily; the tracks property fetches them all once and keeps them.
+    """
+    __slots__ = ("api", "id", "name", "description", "imageUrl", "snapshotId", "trackCount", "_tracks")
+
+    def __init__(self, api: "SpotifyApi", item: dict) -> None:
+        self.api = api
+        self.id = item['id']
+        self.name = item['name']
+        self.description = item.get('description')
+        self.imageUrl = item['images'][0]['url'] if item.get('images') else None
+        self.snapshotId = item.get('snapshot_id')
+        self.trackCount = (item.get('tracks') or {}).get('total', 0)
+        self._tracks: list[SpotifyTrack] | None = None
+
+    def iter_tracks(self, page_size: int = PLAYLIST_ITEMS_PAGE_SIZE):
+        """Yield the playlist's tracks, requesting one page at a time as the caller advances."""
+        if self._tracks is not None:
+            yield from self._tracks
+            return
+        yield from self.api.iter_playlist_tracks(self.id, page_size)
+
+    def fetch_tracks(self) -> list[SpotifyTrack] | None:
+        """Fetch and keep all tracks, or return None if any page failed so the caller can retry later."""
+        if self._tracks is None:
+            self._tracks = self.api.get_playlist_tracks(self.id)
+        return self._tracks
+
+    @property
+    def tracks(self) -> list[SpotifyTrack]:
+        """All tracks, or an empty list if they could not be fetched."""
+        return self.fetch_tracks() or []
+
+    def to_spotify_playlist(self) -> SpotifyPlaylist:
+        return SpotifyPlaylist(
+            id=self.id,
+            name=self.name,
+            description=self.description,
+            imageUrl=self.imageUrl,
+            tracks=self.tracks
+        )
+
+
 class SpotifyApi():
-    def __init__(self):
+    def __init__(self, max_workers: int = 8):
         self.sp_client_credential = SpotifyClientCredentials(client_id=os.getenv("SPOTIFY_CLIENT_ID"),
                                                        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"))
         self.sp_user_credentials = SpotifyOAuth(client_id=os.getenv("SPOTIFY_CLIENT_ID"),
@@ -44,58 +126,96 @@ class SpotifyApi():
                                                        scope="playlist-read-private playlist-read-collaborative")
         self.sp_client = spotipy.Spotify(auth_manager=self.sp_client_credential)
         self.sp_user = spotipy.Spotify(auth_manager=self.sp_user_credentials)
+        self.max_workers = max_workers
+        # Caps Web API requests in flight across all pools, including playlists fetched concurrently
+        self._request_slots = threading.BoundedSemaphore(max_workers)
+
+    def _request(self, fetch, *args):
+        with self._request_slots:
+            return fetch(*args)
+
+    def fetch_all_pages(self, fetch, page_size: int) -> list[dict]:
+        """
+        Fetch every item of a paged endpoint.
+        The first page tells us the total; the remaining pages are then fetched concurrently.
+        At most ``max_workers`` requests are in flight per client, however many pages and
+        playlists are being fetched at once.
+
+        Args:
+            fetch: Callable taking (limit, offset) and returning a Web API paging object
+            page_size (int): Items per request
+
+        Returns:
+            list[dict]: All items, in order
+
+        Raises:
+            IncompletePagesError: A page came back empty-handed; a partial list is never returned
+        """
+        first = self._request(fetch, page_size, 0)
+        if not first or 'items' not in first:
+            raise IncompletePagesError("first page missing")
+        items = list(first['items'])
+        total = first.get('total') or 0
+        offsets = range(page_size, total, page_size)
+        if not offsets:
+            return items
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(offsets))) as executor:
+            pages = executor.map(lambda offset: self._request(fetch, page_size, offset), offsets)
+            for offset, page in zip(offsets, pages):
+                if not page or 'items' not in page:
+                    raise IncompletePagesError(f"page at offset {offset} missing")
+                items.extend(page['items'])
+        return items
 
-    def get_user_playlists(self) -> list[SpotifyPlaylist] | None:
+    def get_user_playlists(self) -> list[PlaylistHandle] | None:
+        """
+        List the user's playlists without fetching any of their tracks.
+        Only the listing pages are requested (50 playlists each); tracks load when a handle is used.
+        """
         try:
-            results = self.sp_user.current_user_playlists()
-        except SpotifyException as e:
+            items = self.fetch_all_pages(
+                lambda limit, offset: self.sp_user.current_user_playlists(limit=limit, offset=offset),
+                USER_PLAYLISTS_PAGE_SIZE,
+            )
+        except (SpotifyException, IncompletePagesError) as e:
             print(f"Error occurred while fetching user playlists: {e}")
             return None
-        if not results: return []
-
-        playlists = []
-        for item in results['items']:
-            playlist = SpotifyPlaylist(
-                id=item['id'],
-                name=item['name'],
-                description=item['description'],
-                imageUrl=item['images'][0]['url'] if item['images'] else None,
-                tracks=self.get_playlist_tracks(item['id'])
-            )
-            playlists.append(playlist)
-        return playlists
+        return [PlaylistHandle(self, item) for item in items if item]
 
     
 
-    def get_playlist_tracks(self, playlist_id: str) -> list[SpotifyTrack]:
+    def get_playlist_tracks(self, playlist_id: str) -> list[SpotifyTrack] | None:
+        """All of a playlist's usable tracks, or None if the playlist could not be fetched completely."""
         try:
-            results = self.sp_user.playlist_items(playlist_id)
-        except SpotifyException as e:
-            print(f"Error occurred while fetching playlist tracks: {e}")
-            return []
-        
-        if not results or 'items' not in results:
-            return []
-        
-        tracks = []
-        for item in results['items']:
-            track_info = item['track']
-            artists = [Artist(id=artist['id'], name=artist['name']) for artist in track_info['artists']]
-            album = Album(
-                id=track_info['album']['id'],
-                name=track_info['album']['name'],
-                artists=[Artist(id=artist['id'], name=artist['name']) for artist in track_info['album']['artists']],
-                imageUrl=track_info['album']['images'][0]['url'] if track_info['album']['images'] else None
+            items = self.fetch_all_pages(
+                lambda limit, offset: self.sp_user.playlist_items(playlist_id, limit=limit, offset=offset),
+                PLAYLIST_ITEMS_PAGE_SIZE,
             )
-            track = SpotifyTrack(
-                id=track_info['id'],
-                name=track_info['name'],
-                artists=artists,
-                album=album,
-                durationMs=track_info['duration_ms'],
-            )
-            tracks.append(track)
-        return tracks
+        except (SpotifyException, IncompletePagesError) as e:
+            print(f"Error occurred while fetching playlist tracks: {e}")
+            return None
+
+        return [parse_track(item['track']) for item in items if is_usable_track(item)]
+
+    def iter_playlist_tracks(self, playlist_id: str, page_size: int = PLAYLIST_ITEMS_PAGE_SIZE):
+        """Yield a playlist's tracks, fetching the next page only once the previous one is consumed."""
+        offset = 0
+        while True:
+            try:
+                page = self._request(
+                    lambda: self.sp_user.playlist_items(playlist_id, limit=page_size, offset=offset))
+            except SpotifyException as e:
+                print(f"Error occurred while fetching playlist tracks: {e}")
+                return
+            if not page or not page.get('items'):
+                return
+            for item in page['items']:
+                if is_usable_track(item):
+                    yield parse_track(item['track'])
+            offset += len(page['items'])
+            if not page.get('next'):
+                return
 
     def search_track(self, query: str, limit: int = 5) -> list[SpotifyTrack]:
         try:
@@ -108,27 +228,146 @@ class SpotifyApi():
         if not results or 'tracks' not in results or 'items' not in results['tracks']:
             return []
         
-        tracks = []
-        for item in results['tracks']['items']:
-            artists = [Artist(id=artist['id'], name=artist['name']) for artist in item['artists']]
-            album = Album(
-                id=item['album']['id'],
-                name=item['album']['name'],
-                artists=[Artist(id=artist['id'], name=artist['name']) for artist in item['album']['artists']],
-                imageUrl=item['album']['images'][0]['url'] if item['album']['images'] else None
-            )
-            track = SpotifyTrack(
-                id=item['id'],
-                name=item['name'],
-                artists=artists,
-                album=album,
-                durationMs=item['duration_ms'],
+        return [parse_track(item) for item in results['tracks']['items']]
+
+
+class CompactTrack:
+    """
+    Memory-light track for large libraries.
+    Artists and albums are shared, interned instances; call to_spotify_track() when a full model is needed.
+    """
+    __slots__ = ("id", "name", "artists", "album", "durationMs")
+
+    def __init__(self, id: str, name: str, artists: tuple[Artist, ...], album: Album, durationMs: int) -> None:
+        self.id = id
+        self.name = name
+        self.artists = artists
+        self.album = album
+        self.durationMs = durationMs
+
+    def to_spotify_track(self) -> SpotifyTrack:
+        # Every field is already validated, and the shared Artist/Album instances are kept as they are
+        return SpotifyTrack.model_construct(
+            id=self.id, name=self.name, artists=list(self.artists), album=self.album, durationMs=self.durationMs
+        )
+
+
+class CompactPlaylist:
+    """Playlist of CompactTracks, convertible to SpotifyPlaylist on demand."""
+    __slots__ = ("id", "name", "description", "imageUrl", "tracks")
+
+    def __init__(self, id: str, name: str, description: str | None, imageUrl: str | None,
+                 tracks: list[CompactTrack]) -> None:
+        self.id = id
+        self.name = name
+        self.description = description
+        self.imageUrl = imageUrl
+        self.tracks = tracks
+
+    def to_spotify_tracks(self) -> list[SpotifyTrack]:
+        return [track.to_spotify_track() for track in self.tracks]
+
+    def to_spotify_playlist(self) -> SpotifyPlaylist:
+        return SpotifyPlaylist.model_construct(
+            id=self.id, name=self.name, description=self.description, imageUrl=self.imageUrl,
+            tracks=self.to_spotify_tracks()
+        )
+
+
+class LibraryInterner:
+    """
+    Builds compact tracks while keeping a single Artist and Album instance per id,
+    so a library where every track repeats its album and artists stores each of them once.
+    """
+
+    def __init__(self) -> None:
+        self.artists: dict[str, Artist] = {}
+        self.albums: dict[str, Album] = {}
+
+    def artist(self, data: dict) -> Artist:
+        artist = self.artists.get(data['id'])
+        if artist is None:
+            artist = self.artists[data['id']] = Artist.model_construct(id=data['id'], name=data['name'])
+        return artist
+
+    def album(self, data: dict) -> Album:
+        album = self.albums.get(data['id'])
+        if album is None:
+            album = self.albums[data['id']] = Album.model_construct(
+                id=data['id'],
+                name=data['name'],
+                artists=[self.artist(artist) for artist in data['artists']],
+                imageUrl=data.get('imageUrl'),
             )
-            tracks.append(track)
-        return tracks
+        return album
+
+    def track(self, data: dict) -> CompactTrack:
+        return CompactTrack(
+            data['id'],
+            data['name'],
+            tuple(self.artist(artist) for artist in data['artists']),
+            self.album(data['album']),
+            data['durationMs'],
+        )
+
+    def playlist(self, data: dict) -> CompactPlaylist:
+        return CompactPlaylist(
+            data['id'],
+            data['name'],
+            data.get('description'),
+            data.get('imageUrl'),
+            [self.track(track) for track in data['tracks']],
+        )
+
+
+def iter_playlist_dump(path: str, interner: LibraryInterner | None = None,
+                       chunk_size: int = 1 << 20):
+    """
+    Stream the playlists of a JSON dump (a list of SpotifyPlaylist objects) one at a time.
+
+    Only the playlist being decoded is held as raw JSON; each one is turned into a
+    CompactPlaylist before the next is read, with artists and albums interned across playlists.
+
+    Args:
+        path (str): Dump written from SpotifyPlaylist.model_dump() objects
+        interner (LibraryInterner, optional): Share artists and albums with other loads
+        chunk_size (int): Characters read from the file at a time
+
+    Yields:
+        CompactPlaylist: Playlists in file order
+    """
+    interner = interner or LibraryInterner()
+    decoder = json.JSONDecoder()
+    with open(path, "r") as file:
+        buffer = file.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} is not a JSON list of playlists")
+        pos = 1
+        eof = False
+        read_size = chunk_size
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError("Need more data", buffer, pos)
+                data, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The playlist continues past the buffer: read more, doubling each time so huge ones stay linear
+                chunk = file.read(read_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                read_size *= 2
+                continue
+            read_size = chunk_size
+            yield interner.playlist(data)
 
 
-def get_user_playlists_tmp() -> list[SpotifyPlaylist] | None:
-    with open("user_playlists_tmp.json", "r") as file:
-        data = json.load(file)
-    return [SpotifyPlaylist(**playlist) for playlist in data]
\ No newline at end of file
+def load_playlist_dump(path: str) -> list[CompactPlaylist]:
+    """Load every playlist of a JSON dump as CompactPlaylists, see iter_playlist_dump."""
+    return list(iter_playlist_dump(path))
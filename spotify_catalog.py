@@ -0,0 +1,191 @@
+"""
+Spotify Catalog
+---------------
+Persistent local copy of the user's playlists, tracks, albums and artists, so a
+run only asks the Web API for playlists that actually changed.
+
+Every stored playlist remembers the ``snapshot_id`` it was fetched at. Spotify
+issues a new snapshot id whenever a playlist's tracks or details change, so a
+sync lists the playlists (one request per 50 playlists), loads every playlist
+whose snapshot is unchanged from SQLite, and fetches tracks only for the rest.
+
+Artists, albums and tracks are stored once each and shared between playlists.
+Loaded playlists are CompactPlaylists built with a LibraryInterner, see spotify_api.
+
+Classes:
+    - SpotifyCatalog
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from spotify_api import CompactPlaylist, LibraryInterner, PlaylistHandle, SpotifyApi, SpotifyTrack
+
+CATALOG_PATH = os.getenv("SPOTIFY_CATALOG_PATH", ".cache/spotify.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (id TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, image_url TEXT, artist_ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, album_id TEXT NOT NULL,
+    artist_ids TEXT NOT NULL, duration_ms INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY, snapshot_id TEXT, name TEXT NOT NULL, description TEXT,
+    image_url TEXT, fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id TEXT NOT NULL, position INTEGER NOT NULL, track_id TEXT NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+);
+"""
+
+
+class SpotifyCatalog:
+    def __init__(self, path: str = CATALOG_PATH) -> None:
+        """
+        Open (or create) the catalog database.
+
+        Args:
+            path (str): SQLite database file, created along with its directory if missing
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.interner = LibraryInterner()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def snapshot_id(self, playlist_id: str) -> Optional[str]:
+        """Snapshot id the stored copy of a playlist was fetched at, or None if it is not stored."""
+        with self._lock:
+            row = self._conn.execute("SELECT snapshot_id FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_playlist(self, handle: PlaylistHandle, tracks: List[SpotifyTrack]) -> None:
+        """Store a playlist and its tracks, replacing the previous copy, in one transaction."""
+        artists: Dict[str, str] = {}
+        albums: Dict[str, tuple] = {}
+        for track in tracks:
+            for artist in [*track.artists, *track.album.artists]:
+                artists[artist.id] = artist.name
+            albums[track.album.id] = (
+                track.album.id, track.album.name, track.album.imageUrl,
+                json.dumps([artist.id for artist in track.album.artists]),
+            )
+
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO artists VALUES (?, ?)", artists.items())
+            self._conn.executemany("INSERT OR REPLACE INTO albums VALUES (?, ?, ?, ?)", albums.values())
+            self._conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", [
+                (track.id, track.name, track.album.id, json.dumps([artist.id for artist in track.artists]),
+                 track.durationMs)
+                for track in tracks
+            ])
+            self._conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (handle.id,))
+            self._conn.executemany("INSERT INTO playlist_tracks VALUES (?, ?, ?)", [
+                (handle.id, position, track.id) for position, track in enumerate(tracks)
+            ])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?, ?)",
+                (handle.id, handle.snapshotId, handle.name, handle.description, handle.imageUrl, time.time()),
+            )
+
+    def load_playlist(self, playlist_id: str) -> Optional[CompactPlaylist]:
+        """Load a stored playlist, or None if it is not in the catalog."""
+        with self._lock:
+            playlist = self._conn.execute(
+                "SELECT id, name, description, image_url FROM playlists WHERE id = ?", (playlist_id,)
+            ).fetchone()
+            if playlist is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT t.id, t.name, t.artist_ids, t.duration_ms, a.id, a.name, a.image_url, a.artist_ids "
+                "FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id JOIN albums a ON a.id = t.album_id "
+                "WHERE p.playlist_id = ? ORDER BY p.position", (playlist_id,)
+            ).fetchall()
+            artist_ids = {artist_id for row in rows for column in (row[2], row[7]) for artist_id in json.loads(column)}
+            artist_names = self._artist_names(artist_ids)
+
+        def artists(column: str) -> List[dict]:
+            return [{'id': artist_id, 'name': artist_names[artist_id]} for artist_id in json.loads(column)]
+
+        return self.interner.playlist({
+            'id': playlist[0],
+            'name': playlist[1],
+            'description': playlist[2],
+            'imageUrl': playlist[3],
+            'tracks': [
+                {
+                    'id': track_id,
+                    'name': name,
+                    'artists': artists(track_artists),
+                    'album': {'id': album_id, 'name': album_name, 'imageUrl': image_url,
+                              'artists': artists(album_artists)},
+                    'durationMs': duration_ms,
+                }
+                for track_id, name, track_artists, duration_ms, album_id, album_name, image_url, album_artists in rows
+            ],
+        })
+
+    def _artist_names(self, artist_ids) -> Dict[str, str]:
+        names: Dict[str, str] = {}
+        artist_ids = list(artist_ids)
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(artist_ids), 500):
+            batch = artist_ids[start:start + 500]
+            names.update(self._conn.execute(
+                f"SELECT id, name FROM artists WHERE id IN ({','.join('?' * len(batch))})", batch
+            ).fetchall())
+        return names
+
+    def sync(self, api: SpotifyApi, max_workers: int = 8) -> Optional[List[CompactPlaylist]]:
+        """
+        Bring the catalog up to date with the user's playlists and return all of them.
+
+        Playlists whose snapshot id matches the stored one load locally with no API calls;
+        only new or changed playlists have their tracks fetched, several at a time.
+        A playlist that cannot be fetched completely is not saved: its stored copy, if any,
+        is returned and it is fetched again on the next sync.
+
+        Args:
+            api (SpotifyApi): Authenticated client
+            max_workers (int): Playlists fetched concurrently
+
+        Returns:
+            Optional[List[CompactPlaylist]]: Playlists in listing order, or None if the listing failed
+        """
+        handles = api.get_user_playlists()
+        if handles is None:
+            return None
+        changed = [handle for handle in handles
+                   if handle.snapshotId is None or handle.snapshotId != self.snapshot_id(handle.id)]
+        print(f"🗂️  Catalog: {len(handles) - len(changed)} playlists unchanged, {len(changed)} to fetch")
+
+        def refresh(handle: PlaylistHandle) -> None:
+            tracks = handle.fetch_tracks()
+            if tracks is None:
+                # Keep the old snapshot id so the playlist is fetched again on the next sync
+                print(f"⚠️  Could not fetch '{handle.name}', keeping the stored copy until the next sync")
+                return
+            self.save_playlist(handle, tracks)
+
+        if changed:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(refresh, changed))
+        return [playlist for playlist in (self.load_playlist(handle.id) for handle in handles) if playlist]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
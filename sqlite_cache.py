@@ -0,0 +1,141 @@
+"""
+SQLite Cache
+------------
+Small persistent key/value cache backed by SQLite, shared by the modules that
+want to avoid repeating slow or quota-limited network calls.
+
+Values are stored as JSON. Entries expire after a configurable TTL and the table
+is kept under a maximum size by evicting the least recently used rows.
+
+Classes:
+    - SqliteCache
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class SqliteCache:
+    def __init__(self, path: str, table: str = "cache", ttl_seconds: Optional[float] = None,
+                 max_entries: Optional[int] = None) -> None:
+        """
+        Open (or create) a cache table.
+
+        Args:
+            path (str): SQLite database file, created along with its directory if missing
+            table (str): Table name, lets several caches share one database file
+            ttl_seconds (float, optional): Entry lifetime. None means entries never expire
+            max_entries (int, optional): LRU size bound. None means unbounded
+        """
+        if not table.isidentifier():
+            raise ValueError(f"Invalid cache table name: {table}")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for ``key``, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store ``value`` under ``key`` and evict old entries if over the size bound."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key: str) -> bool:
+        """Remove a single entry. Returns True if it existed."""
+        with self._lock:
+            cursor = self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Remove every entry whose key starts with ``prefix``. Returns the number removed."""
+        with self._lock:
+            cursor = self._conn.execute(
+                f"DELETE FROM {self.table} WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def clear(self) -> int:
+        """Remove every entry from the cache. Returns the number removed."""
+        with self._lock:
+            cursor = self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+        return cursor.rowcount
+
+    def _evict(self) -> None:
+        # Caller holds the lock
+        if self.ttl_seconds is not None:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            )
+        if self.max_entries is not None:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the current entry count."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -12,10 +12,11 @@ class VideoSelection(BaseModel):
     reason: str = Field(..., description="Explanation for why this video was selected")
 
 
-from spotify_api import get_user_playlists_tmp
-playlists = get_user_playlists_tmp()
+from spotify_api import SpotifyApi
+from spotify_catalog import SpotifyCatalog
+playlists = SpotifyCatalog().sync(SpotifyApi())
 playlist = playlists[7]
-track = playlist.tracks[0]
+track = playlist.tracks[0].to_spotify_track()
 song_metadata = track.model_dump()
 
 import json
@@ -3,12 +3,20 @@
 # Loads API_KEY from .env using python-dotenv
 
 
+import asyncio
 import os
-from typing import List
+import re
+import threading
+from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 import googleapiclient.discovery
+import httplib2
 from pydantic import BaseModel
 
+import metrics
+from sqlite_cache import SqliteCache
+from youtube_quota import SEARCH_COST, VIDEOS_LIST_COST, QuotaExceededError, QuotaTracker, is_quota_error
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -17,25 +25,144 @@ def get_api_key():
     return os.getenv('YOUTUBE_API_KEY')
 
 
+# Root URL of the Data API, overridable to point at a local stand-in (e.g. http://127.0.0.1:8000/)
+YOUTUBE_API_ENDPOINT = os.getenv("YOUTUBE_API_ENDPOINT")
+
+
+# The discovery document is parsed once and the resulting service object is shared.
+# httplib2 connections are not thread-safe, so every thread keeps its own keep-alive
+# Http instance and passes it to request.execute().
+_client: Optional[Any] = None
+_client_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def get_youtube_client():
+    """Return the shared YouTube Data API service, building it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                client_options = {"api_endpoint": YOUTUBE_API_ENDPOINT} if YOUTUBE_API_ENDPOINT else None
+                _client = googleapiclient.discovery.build(
+                    "youtube", "v3", developerKey=get_api_key(), cache_discovery=False,
+                    client_options=client_options
+                )
+    return _client
+
+
+def get_thread_http() -> httplib2.Http:
+    """Return this thread's pooled HTTP connection, reused across requests."""
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = httplib2.Http(timeout=30)
+        _thread_local.http = http
+    return http
+
+
 class YouTubeSearchResult(BaseModel):
     title: str
     videoId: str
     channelTitle: str
     publishedAt: str
     description: str
+    durationMs: Optional[int] = None
+
+
+# Search results are cached on disk so re-running a playlist costs no quota.
+# TTL and size can be tuned from .env; set YOUTUBE_SEARCH_CACHE_TTL=0 to disable expiry.
+SEARCH_CACHE_PATH = os.getenv('YOUTUBE_SEARCH_CACHE_PATH', '.cache/youtube.sqlite3')
+SEARCH_CACHE_TTL = float(os.getenv('YOUTUBE_SEARCH_CACHE_TTL', 30 * 24 * 3600))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('YOUTUBE_SEARCH_CACHE_MAX_ENTRIES', 50_000))
+
+_search_cache: Optional[SqliteCache] = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SqliteCache:
+    """Return the shared on-disk search cache, opening it on first use."""
+    global _search_cache
+    # Locked so concurrent first searches share one cache instead of each opening their own
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SqliteCache(
+                SEARCH_CACHE_PATH,
+                table="youtube_search",
+                ttl_seconds=SEARCH_CACHE_TTL or None,
+                max_entries=SEARCH_CACHE_MAX_ENTRIES,
+            )
+    return _search_cache
+
 
-def youtube_search(query: str, max_results: int = 5) -> List[YouTubeSearchResult]:
+# Video durations never change, so they are cached without expiry
+DURATION_CACHE_MAX_ENTRIES = int(os.getenv('YOUTUBE_DURATION_CACHE_MAX_ENTRIES', 200_000))
+# videos.list accepts at most 50 ids per request
+VIDEOS_LIST_BATCH_SIZE = 50
+
+_duration_cache: Optional[SqliteCache] = None
+_duration_cache_lock = threading.Lock()
+
+
+def get_duration_cache() -> SqliteCache:
+    """Return the shared on-disk cache of video durations, opening it on first use."""
+    global _duration_cache
+    with _duration_cache_lock:
+        if _duration_cache is None:
+            _duration_cache = SqliteCache(
+                SEARCH_CACHE_PATH,
+                table="video_duration",
+                max_entries=DURATION_CACHE_MAX_ENTRIES,
+            )
+    return _duration_cache
+
+
+_quota_tracker: Optional[QuotaTracker] = None
+_quota_tracker_lock = threading.Lock()
+
+
+def get_quota_tracker() -> QuotaTracker:
+    """Return the shared daily quota tracker, stored alongside the search cache."""
+    global _quota_tracker
+    # Locked so concurrent first searches cannot each create a tracker and double-spend the budget
+    with _quota_tracker_lock:
+        if _quota_tracker is None:
+            # Two days of history is enough to span the Pacific-time day boundary
+            _quota_tracker = QuotaTracker(
+                SqliteCache(SEARCH_CACHE_PATH, table="youtube_quota", ttl_seconds=2 * 24 * 3600)
+            )
+    return _quota_tracker
+
+
+def parse_iso8601_duration(duration: str) -> Optional[int]:
+    """Convert an ISO 8601 duration such as 'PT3M35S' into milliseconds."""
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?', duration or '')
+    if not match:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    total = int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+    return int(total * 1000)
+
+
+def search_cache_key(query: str, max_results: int) -> str:
+    """Normalize a query so that case and whitespace differences share a cache entry."""
+    normalized = re.sub(r'\s+', ' ', query).strip().casefold()
+    return f"{max_results}:{normalized}"
+
+
+def youtube_search(query: str, max_results: int = 5, use_cache: bool = True) -> List[YouTubeSearchResult]:
     """
     Searches YouTube for videos based on a query.
 
     Args:
         query: The search term.
         max_results: The maximum number of results to return (default is 5).
+        use_cache: Serve and store results in the on-disk search cache (default is True).
 
     Returns:
         A list of dictionaries, where each dictionary represents a search result
         and contains 'title', 'videoId', and 'channelTitle'.
-        Returns an empty list if no results are found or an error occurs.
+        Returns an empty list if no results are found or a request fails for any reason
+        other than the quota; quota exhaustion raises QuotaExceededError instead.
 
         Example:
         [
@@ -47,9 +174,23 @@ def youtube_search(query: str, max_results: int = 5) -> List[YouTubeSearchResult
               "description":"Music video by AURORA performing Echo of My Shadow (Visualiser).© 2024 Universal Music Operations Limited."
           },
         ]
+
+    Raises:
+        QuotaExceededError: The day's API quota cannot cover the search (100 units), or the API
+        reports it as spent. Cached results are still served once the quota is spent.
     """
+    cache_key = search_cache_key(query, max_results)
+    if use_cache:
+        cached = get_search_cache().get(cache_key)
+        if cached is not None:
+            return [YouTubeSearchResult(**item) for item in cached]
+
+    quota = get_quota_tracker()
+    if not quota.try_spend(SEARCH_COST):
+        raise QuotaExceededError(f"YouTube search quota spent for today ({quota.spent()}/{quota.daily_units} units)")
+
     try:
-        youtube = googleapiclient.discovery.build("youtube", "v3", developerKey=get_api_key())
+        youtube = get_youtube_client()
 
         request = youtube.search().list(
             part="snippet",
@@ -57,7 +198,8 @@ def youtube_search(query: str, max_results: int = 5) -> List[YouTubeSearchResult
             maxResults=max_results,
             type="video"
         )
-        response = request.execute()
+        with metrics.timer("youtube.search"):
+            response = request.execute(http=get_thread_http())
 
         search_results: List[YouTubeSearchResult] = []
         for item in response.get("items", []):
@@ -69,11 +211,111 @@ def youtube_search(query: str, max_results: int = 5) -> List[YouTubeSearchResult
                 description=item["snippet"]["description"]
             ))
 
+        if use_cache:
+            get_search_cache().set(cache_key, [result.model_dump() for result in search_results])
         return search_results
 
     except Exception as e:
+        if is_quota_error(e):
+            quota.mark_exhausted()
+            raise QuotaExceededError(f"YouTube API reports the daily quota as spent: {e}") from e
         print(f"An error occurred: {e}")
         return []
 
 
+async def youtube_search_many(queries: List[str], max_results: int = 5, max_concurrency: int = 8,
+                              use_cache: bool = True) -> List[List[YouTubeSearchResult]]:
+    """
+    Run many searches concurrently on a bounded number of worker threads.
+
+    Args:
+        queries: Search terms.
+        max_results: The maximum number of results per query (default is 5).
+        max_concurrency: Maximum number of searches in flight at once (default is 8).
+        use_cache: Serve and store results in the on-disk search cache (default is True).
+
+    Returns:
+        A list of result lists, in the same order as ``queries``.
+
+    Raises:
+        QuotaExceededError: The daily quota ran out before every query was answered.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def search(query: str) -> List[YouTubeSearchResult]:
+        async with semaphore:
+            return await asyncio.to_thread(youtube_search, query, max_results, use_cache)
+
+    return list(await asyncio.gather(*(search(query) for query in queries)))
+
+
+def fetch_video_durations(video_ids: List[str]) -> Dict[str, int]:
+    """
+    Look up the duration of many videos, 50 ids per videos.list request (1 quota unit each).
+
+    Args:
+        video_ids: YouTube video ids, duplicates are fetched once.
 
+    Returns:
+        A dict mapping video id to duration in milliseconds. Videos that could not be
+        resolved (removed, private or failed requests, or no quota left) are left out.
+    """
+    cache = get_duration_cache()
+    durations: Dict[str, int] = {}
+    missing: List[str] = []
+    for video_id in dict.fromkeys(video_ids):
+        cached = cache.get(video_id)
+        if cached is not None:
+            durations[video_id] = cached
+        else:
+            missing.append(video_id)
+
+    for start in range(0, len(missing), VIDEOS_LIST_BATCH_SIZE):
+        batch = missing[start:start + VIDEOS_LIST_BATCH_SIZE]
+        if not get_quota_tracker().try_spend(VIDEOS_LIST_COST, use_reserve=True):
+            print("YouTube quota spent for today, skipping remaining video duration lookups")
+            break
+        try:
+            request = get_youtube_client().videos().list(
+                part="contentDetails",
+                id=",".join(batch),
+                maxResults=VIDEOS_LIST_BATCH_SIZE
+            )
+            with metrics.timer("youtube.videos"):
+                response = request.execute(http=get_thread_http())
+        except Exception as e:
+            if is_quota_error(e):
+                get_quota_tracker().mark_exhausted()
+                print("YouTube API reports the daily quota as spent, skipping remaining video duration lookups")
+                break
+            print(f"An error occurred while fetching video durations: {e}")
+            continue
+
+        for item in response.get("items", []):
+            duration_ms = parse_iso8601_duration(item.get("contentDetails", {}).get("duration", ""))
+            if duration_ms is not None:
+                durations[item["id"]] = duration_ms
+                cache.set(item["id"], duration_ms)
+
+    return durations
+
+
+def enrich_with_durations(results: List[List[YouTubeSearchResult]]) -> List[List[YouTubeSearchResult]]:
+    """
+    Fill in ``durationMs`` on the results of many searches with as few API calls as possible.
+
+    Args:
+        results: Result lists, e.g. from youtube_search_many. Updated in place.
+
+    Returns:
+        The same result lists, for convenience.
+    """
+    video_ids = [result.videoId for result_list in results for result in result_list if result.durationMs is None]
+    if not video_ids:
+        return results
+    durations = fetch_video_durations(video_ids)
+    for result_list in results:
+        for result in result_list:
+            if result.durationMs is None:
+                result.durationMs = durations.get(result.videoId)
+    return results
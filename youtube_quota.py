@@ -0,0 +1,105 @@
+"""
+YouTube Quota
+-------------
+Accounting for the YouTube Data API's daily quota, persisted across runs.
+
+Every project gets 10,000 units a day, reset at midnight Pacific time. A search
+costs 100 units and a videos.list call 1 unit. Units are reserved before each
+request, so once the budget is spent further calls fail immediately with
+QuotaExceededError instead of hitting the API. Callers decide whether to pause
+until the reset or to use another search backend.
+
+The last QUOTA_RESERVE_UNITS are kept for videos.list, so duration lookups for
+candidates that were already found still work after searches run out.
+
+Usage is stored per Pacific day in the search cache database. Counts are exact
+within one process; concurrent processes may overshoot slightly, which the API
+itself then reports as quotaExceeded.
+
+Classes:
+    - QuotaExceededError
+    - QuotaTracker
+
+Functions:
+    - is_quota_error
+
+The shared tracker is youtube_api.get_quota_tracker().
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from sqlite_cache import SqliteCache
+
+DAILY_QUOTA_UNITS = int(os.getenv("YOUTUBE_DAILY_QUOTA", 10_000))
+QUOTA_RESERVE_UNITS = int(os.getenv("YOUTUBE_QUOTA_RESERVE", 20))
+SEARCH_COST = 100
+VIDEOS_LIST_COST = 1
+
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+class QuotaExceededError(RuntimeError):
+    """The day's YouTube Data API quota is spent."""
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Whether an API error is the daily quota running out (HTTP 403 quotaExceeded/dailyLimitExceeded)."""
+    if getattr(getattr(error, "resp", None), "status", None) != 403:
+        return False
+    content = getattr(error, "content", b"") or b""
+    return b"quotaExceeded" in content or b"dailyLimitExceeded" in content
+
+
+class QuotaTracker:
+    def __init__(self, cache: SqliteCache, daily_units: int = DAILY_QUOTA_UNITS,
+                 reserve_units: int = QUOTA_RESERVE_UNITS) -> None:
+        self.cache = cache
+        self.daily_units = daily_units
+        self.reserve_units = reserve_units
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def quota_day(now: Optional[datetime] = None) -> str:
+        return (now or datetime.now(QUOTA_TIMEZONE)).astimezone(QUOTA_TIMEZONE).date().isoformat()
+
+    def spent(self) -> int:
+        """Units spent so far today."""
+        return self.cache.get(self.quota_day()) or 0
+
+    def remaining(self) -> int:
+        return max(self.daily_units - self.spent(), 0)
+
+    def try_spend(self, units: int, use_reserve: bool = False) -> bool:
+        """
+        Reserve ``units`` for a request about to be made.
+
+        Args:
+            units (int): Cost of the request
+            use_reserve (bool): Allow dipping into the units kept back for videos.list
+
+        Returns:
+            bool: False, with nothing spent, if the budget cannot cover the request
+        """
+        limit = self.daily_units if use_reserve else self.daily_units - self.reserve_units
+        with self._lock:
+            day = self.quota_day()
+            spent = self.cache.get(day) or 0
+            if spent + units > limit:
+                return False
+            self.cache.set(day, spent + units)
+            return True
+
+    def mark_exhausted(self) -> None:
+        """Record that the API reported the quota as spent, whatever the local count says."""
+        with self._lock:
+            self.cache.set(self.quota_day(), self.daily_units)
+
+    def seconds_until_reset(self) -> float:
+        now = datetime.now(QUOTA_TIMEZONE)
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), QUOTA_TIMEZONE)
+        return max((midnight - now).total_seconds(), 0.0)
+